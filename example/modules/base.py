@@ -113,7 +113,7 @@ def base() -> ConfigDict:
       """, user = "manuel"), tags = "bootstrap"),
       File(
         filename = "/etc/paru.conf",
-        before = lambda item: isinstance(item, Package) and "bootstrap" not in item.tags,
+        before = OfType(Package) & ~Tagged("bootstrap"),
         content = cleandoc('''
           [options]
           PgpFetch
@@ -512,7 +512,7 @@ def base() -> ConfigDict:
 
     Section("flatpak and flathub"): (
       # flatpak currently required by plasma-meta
-      Package("flatpak", before = lambda item: isinstance(item, FlatpakRepo) or isinstance(item, FlatpakPackage)),
+      Package("flatpak", before = OfType(FlatpakRepo, FlatpakPackage)),
       FlatpakRepo("flathub", spec_url = "https://dl.flathub.org/repo/flathub.flatpakrepo"),
     ),
 
@@ -3,3 +3,4 @@ from koti.core import *
 from koti.items import *
 from koti.managers import *
 from koti.presets import *
+from koti.selectors import *
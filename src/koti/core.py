@@ -1,12 +1,14 @@
 from __future__ import annotations
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from os import getuid
 from time import sleep
+from typing import Unpack
 
 import koti.utils.shell as shell_module
 from koti.model import *
-from koti.optimizer import CleanupPhaseOptimizer, InfeasibleError, InstallPhaseOptimizer
+from koti.optimizer import CleanupPhaseOptimizer, InfeasibleError, InstallPhaseOptimizer, InstallPhaseOptimizerArgs, InstallPlanCache
 from koti.utils.error_handling import handle_ctrl_c
 from koti.utils.text import *
 from koti.utils.confirm import confirm
@@ -16,18 +18,24 @@ from koti.utils.logging import logger
 
 class Koti:
   store: JsonStore
-  managers: Sequence[ConfigManager]
+  managers: ManagerRegistry
   configs: ConfigDict
+  state_probe_workers: int
+  optimizer_args: InstallPhaseOptimizerArgs
 
   def __init__(
     self,
     managers: Sequence[ConfigManager] | Iterable[ConfigManager],
     configs: ConfigDict,
+    state_probe_workers: int = 1,
+    **optimizer_args: Unpack[InstallPhaseOptimizerArgs],
   ):
     assert getuid() == 0, "this program must be run as root (or through sudo)"
     self.store = JsonStore("/var/cache/koti/Koti.json")
     self.configs = configs
-    self.managers = list(managers)
+    self.managers = ManagerRegistry(managers)
+    self.state_probe_workers = state_probe_workers
+    self.optimizer_args = {"plan_cache": InstallPlanCache(), **optimizer_args}
     self.assert_manager_consistency(self.managers, self.configs)
 
   def create_model(self) -> ConfigModel:
@@ -35,6 +43,7 @@ class Koti:
     optimizer = InstallPhaseOptimizer(
       configs = self.get_managed_items_grouped(merged_configs),
       managers = self.managers,
+      **self.optimizer_args,
     )
 
     try:
@@ -61,7 +70,11 @@ class Koti:
 
   def create_cleanup_phase(self, model: ConfigModel) -> CleanupPhase:
     try:
-      optimizer = CleanupPhaseOptimizer(self.managers)
+      optimizer = CleanupPhaseOptimizer(
+        self.managers,
+        time_limit = self.optimizer_args.get("time_limit", None),
+        gap_limit = self.optimizer_args.get("gap_limit", None),
+      )
       managers_in_order = optimizer.calc_cleanup_order()
     except InfeasibleError:
       raise AssertionError("cleanup order could not be determined because of infeasible constraints defined by cleanup_order_before / cleanup_order_after")
@@ -70,7 +83,7 @@ class Koti:
     return CleanupPhase(steps = [
       CleanupStep(
         manager = manager,
-        items_to_keep = [item for item in items_to_install if item.__class__ in manager.managed_classes],
+        items_to_keep = [item for item in items_to_install if self.managers.manager_for(item) is manager],
       ) for manager in managers_in_order
     ])
 
@@ -87,21 +100,27 @@ class Koti:
 
     for manager in self.managers:
       manager.initialize(model, dryrun = True)
+    if self.state_probe_workers > 1:
+      self.prefetch_states(model, system_state)
     for install_step in model.steps:
       sys.stdout.write(".")
       sys.stdout.flush()
+      system_state.prefetch(install_step.manager, install_step.items_to_install, system_state)
       for action in install_step.manager.get_install_actions(install_step.items_to_install, model, system_state):
         actions.append(action)
         self.update_dry_run_state(action, system_state)
     cleanup_phase = self.create_cleanup_phase(model)
+    system_state.clear()
     for cleanup_step in cleanup_phase.steps:
       sys.stdout.write(".")
       sys.stdout.flush()
+      system_state.prefetch(cleanup_step.manager, cleanup_step.items_to_keep, system_state)
       for action in cleanup_step.manager.get_cleanup_actions(cleanup_step.items_to_keep, model, system_state):
         actions.append(action)
         self.update_dry_run_state(action, system_state)
     for manager in self.managers:
       manager.finalize(model, dryrun = True)
+    logger.info(system_state.statistics())
 
     print()
     print()
@@ -150,10 +169,23 @@ class Koti:
       model = model,
     )
 
+  def prefetch_states(self, model: ConfigModel, system_state: CachingSystemState):
+    """Probes the current states of all items to install concurrently, one task per manager, before the sequential
+    simulation starts. Only managers with a batched get_states() take part, as the others may read further states
+    through system_state. Results are stored in a fixed order, so the plan doesn't depend on thread timing."""
+    items_by_manager: dict[ConfigManager, list[ManagedConfigItem]] = {}
+    for install_step in model.steps:
+      if install_step.manager.has_batched_get_states():
+        items_by_manager.setdefault(install_step.manager, []).extend(install_step.items_to_install)
+    with ThreadPoolExecutor(max_workers = self.state_probe_workers) as executor:
+      futures = [executor.submit(manager.get_states, list(dict.fromkeys(items)), system_state) for manager, items in items_by_manager.items()]
+      for future in futures:
+        system_state.put_prefetched(future.result())
+
   @handle_ctrl_c
   def execute(self, plan: ExecutionPlan):
     logger.clear()
-    system_state = ActualSystemState(self.managers)
+    system_state = CachingSystemState(ActualSystemState(self.managers))
     model = plan.model
 
     for manager in self.managers:
@@ -161,18 +193,24 @@ class Koti:
 
     # execute install phases
     for install_step in model.steps:
+      system_state.prefetch(install_step.manager, install_step.items_to_install, system_state)
       for action in install_step.manager.get_install_actions(install_step.items_to_install, model, system_state):
         self.execute_action(action, plan)
+        system_state.invalidate([*action.installs, *action.updates, *action.removes])
 
     # execute cleanup phase
     cleanup_phase = self.create_cleanup_phase(model)
+    system_state.clear()
     for cleanup_step in cleanup_phase.steps:
+      system_state.prefetch(cleanup_step.manager, cleanup_step.items_to_keep, system_state)
       for action in cleanup_step.manager.get_cleanup_actions(cleanup_step.items_to_keep, model, system_state):
         self.execute_action(action, plan)
+        system_state.invalidate([*action.installs, *action.updates, *action.removes])
 
     # updating persistent data
     for manager in self.managers:
       manager.finalize(model, dryrun = False)
+    logger.info(system_state.statistics())
 
     self.print_divider_line()
     print("execution finished.")
@@ -248,10 +286,11 @@ class Koti:
   @classmethod
   def assert_manager_consistency(cls, managers: Sequence[ConfigManager], configs: ConfigDict):
     """Checks that every item has a manager and only one manager"""
+    registry = ManagerRegistry.of(managers)
     for section, items in cls.iterate_effective_configs(configs):
       for item in items:
         if not isinstance(item, ManagedConfigItem): continue
-        matching_managers = [manager for manager in managers if item.__class__ in manager.managed_classes]
+        matching_managers = registry.managers_for(item.__class__)
         assert len(matching_managers) > 0, f"no manager found for class {item.__class__.__name__}"
         assert len(matching_managers) < 2, f"multiple managers found for class {item.__class__.__name__}"
 
@@ -0,0 +1,494 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Any, Sequence
+
+
+class InstallGraph:
+  """Index-based representation of the ordering constraints between config items. Node i stands for the
+  i-th item, an edge (u, v) with weight w means that v has to be installed at least w steps after u. A weight of
+  0 allows both items to share a step, a weight of 1 forces them into separate steps. Each node is tagged with
+  the index of its manager; a step may only ever contain items of the same manager.
+  (The graph only consists of plain integers, so it is cheap to copy, hash and pass around.)"""
+  managers: list[int]
+  groups: list[list[int]]
+  edges: dict[tuple[int, int], int]
+  naive_constraint_count: int  # number of constraints when pairwise constraining all items within each group
+
+  def __init__(self, managers: Sequence[int], groups: Sequence[Sequence[int]], edges: dict[tuple[int, int], int], naive_constraint_count: int | None = None):
+    self.managers = list(managers)
+    self.groups = [list(group) for group in groups]
+    self.edges = dict(edges)
+    self.naive_constraint_count = naive_constraint_count if naive_constraint_count is not None else len(self.edges)
+
+  @classmethod
+  def from_groups(cls, managers: Sequence[int], groups: Sequence[Sequence[int]], edges: dict[tuple[int, int], int]) -> InstallGraph:
+    """Creates a graph containing the given edges plus the ordering constraints within each group."""
+    result = InstallGraph(
+      managers = managers,
+      groups = groups,
+      edges = {},
+      naive_constraint_count = len(edges) + sum(len(group) * (len(group) - 1) // 2 for group in groups),
+    )
+    for group in result.groups:
+      for node1, node2 in zip(group[:-1], group[1:]):
+        # a chain of consecutive items is equivalent to constraining every pair within the group: the gap between
+        # two items of different managers always contains at least one manager change along the chain
+        result.add_edge(node1, node2, 1 if result.managers[node1] != result.managers[node2] else 0)
+    for (node1, node2), weight in edges.items():
+      result.add_edge(node1, node2, weight)
+    return result
+
+  @property
+  def size(self) -> int:
+    return len(self.managers)
+
+  def add_edge(self, node1: int, node2: int, weight: int):
+    if node1 == node2 and weight == 0:
+      return  # trivially satisfied
+    self.edges[(node1, node2)] = max(weight, self.edges.get((node1, node2), 0))
+
+  def successors(self) -> list[dict[int, int]]:
+    result: list[dict[int, int]] = [{} for _ in range(self.size)]
+    for (node1, node2), weight in self.edges.items():
+      result[node1][node2] = weight
+    return result
+
+  def predecessors(self) -> list[dict[int, int]]:
+    result: list[dict[int, int]] = [{} for _ in range(self.size)]
+    for (node1, node2), weight in self.edges.items():
+      result[node2][node1] = weight
+    return result
+
+  def subgraph(self, nodes: Sequence[int]) -> InstallGraph:
+    """Returns the graph induced by the given nodes, renumbered in the given order. Groups are only kept if all
+    of their members are part of the subgraph (which is always the case for connected components)."""
+    node_map = {node: idx for idx, node in enumerate(nodes)}
+    return InstallGraph(
+      managers = [self.managers[node] for node in nodes],
+      groups = [[node_map[node] for node in group] for group in self.groups if all(node in node_map for node in group)],
+      edges = {(node_map[node1], node_map[node2]): weight for (node1, node2), weight in self.edges.items() if node1 in node_map and node2 in node_map},
+    )
+
+  def quotient(self, classes: Sequence[int]) -> InstallGraph:
+    """Returns the graph with each class of nodes merged into a single node. classes[node] has to be the index of
+    the node's class, numbered consecutively. Groups are kept (with consecutive duplicates removed)."""
+    groups: list[list[int]] = []
+    for group in self.groups:
+      groups.append([])
+      for node in group:
+        if not groups[-1] or groups[-1][-1] != classes[node]:
+          groups[-1].append(classes[node])
+    managers = [0] * (max(classes, default = -1) + 1)
+    for node, manager in enumerate(self.managers):
+      managers[classes[node]] = manager
+    result = InstallGraph(
+      managers = managers,
+      groups = groups,
+      edges = {},
+      naive_constraint_count = self.naive_constraint_count,
+    )
+    for (node1, node2), weight in self.edges.items():
+      result.add_edge(classes[node1], classes[node2], weight)
+    return result
+
+  def contract_interchangeable(self) -> tuple[InstallGraph, list[int]]:
+    """Merges nodes that can always share a step without affecting the result, so the solver needs fewer
+    variables. Returns the contracted graph and the index of the merged node for each node. Two kinds of nodes
+    get merged, both only if they belong to the same manager:
+    - a node and its only successor, connected via a zero-weight edge that is also the successor's only incoming
+      edge (e.g. the items of `Package("a", "b", "c")` within a section)
+    - nodes with identical incoming and outgoing edges"""
+    predecessors = self.predecessors()
+    successors = self.successors()
+    parents = list(range(self.size))
+
+    def find(node: int) -> int:
+      while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+      return node
+
+    for (node1, node2), weight in self.edges.items():
+      if weight == 0 and len(successors[node1]) == 1 and len(predecessors[node2]) == 1 and self.managers[node1] == self.managers[node2]:
+        parents[find(node2)] = find(node1)
+    series_classes = self.number_classes([find(node) for node in range(self.size)])
+    series_graph = self.quotient(series_classes)
+
+    series_predecessors = series_graph.predecessors()
+    series_successors = series_graph.successors()
+    signatures = [
+      (series_graph.managers[node], frozenset(series_predecessors[node].items()), frozenset(series_successors[node].items()))
+      for node in range(series_graph.size)
+    ]
+    parallel_classes = self.number_classes(signatures)
+    return series_graph.quotient(parallel_classes), [parallel_classes[series_class] for series_class in series_classes]
+
+  @classmethod
+  def number_classes(cls, keys: Sequence[Any]) -> list[int]:
+    """Numbers distinct keys consecutively, in order of their first occurrence."""
+    numbers: dict[Any, int] = {}
+    return [numbers.setdefault(key, len(numbers)) for key in keys]
+
+  def stages(self, barriers: Sequence[int]) -> list[list[int]]:
+    """Splits the nodes at the given barrier nodes: each barrier forms a stage together with all of its (not yet
+    assigned) ancestors, the remaining nodes form the last stage. Barriers are processed in topological order, so
+    all edges between stages point forward. Requires an acyclic graph."""
+    order = self.topological_order()
+    assert order is not None, "stages are only defined for acyclic graphs"
+    predecessors = self.predecessors()
+    order_index = {node: idx for idx, node in enumerate(order)}
+    stage_for_node: list[int | None] = [None] * self.size
+    stage_count = 0
+    for barrier in sorted(set(barriers), key = lambda node: order_index[node]):
+      stack = [barrier]
+      stage_for_node[barrier] = stage_count
+      while stack:
+        for other in predecessors[stack.pop()]:
+          if stage_for_node[other] is None:
+            stage_for_node[other] = stage_count
+            stack.append(other)
+      stage_count += 1
+    result: list[list[int]] = [[] for _ in range(stage_count + 1)]
+    for node, stage in enumerate(stage_for_node):
+      result[stage if stage is not None else stage_count].append(node)
+    return [stage for stage in result if stage]
+
+  def components(self) -> list[list[int]]:
+    """Weakly connected components (i.e. ignoring edge directions), each sorted by node index. Items of different
+    components don't constrain each other at all, they only compete for steps of the same manager."""
+    parents = list(range(self.size))
+
+    def find(node: int) -> int:
+      while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+      return node
+
+    for (node1, node2) in self.edges:
+      root1, root2 = find(node1), find(node2)
+      if root1 != root2:
+        parents[max(root1, root2)] = min(root1, root2)
+    result: dict[int, list[int]] = defaultdict(list)
+    for node in range(self.size):
+      result[find(node)].append(node)
+    return list(result.values())
+
+  def topological_order(self) -> list[int] | None:
+    """Kahn's algorithm. Returns None if the graph contains a cycle."""
+    successors = self.successors()
+    indegree = [0] * self.size
+    for (node1, node2) in self.edges:
+      indegree[node2] += 1
+    queue = [node for node in range(self.size) if indegree[node] == 0]
+    result: list[int] = []
+    while queue:
+      node = queue.pop()
+      result.append(node)
+      for other in successors[node]:
+        indegree[other] -= 1
+        if indegree[other] == 0:
+          queue.append(other)
+    return result if len(result) == self.size else None
+
+  def tail_lengths(self, order: Sequence[int]) -> list[int]:
+    """Length of the longest (weighted) path starting at each node. Requires a topological order."""
+    successors = self.successors()
+    result = [0] * self.size
+    for node in reversed(order):
+      result[node] = max((weight + result[other] for other, weight in successors[node].items()), default = 0)
+    return result
+
+  def head_lengths(self, order: Sequence[int]) -> list[int]:
+    """Length of the longest (weighted) path ending at each node. Requires a topological order."""
+    predecessors = self.predecessors()
+    result = [0] * self.size
+    for node in order:
+      result[node] = max((weight + result[other] for other, weight in predecessors[node].items()), default = 0)
+    return result
+
+  def lower_bound(self) -> int:
+    """Minimum number of steps that any valid install order needs: each weighted path has to be spread over
+    distinct steps, and each manager needs at least one step of its own."""
+    order = self.topological_order()
+    assert order is not None, "lower bound is only defined for acyclic graphs"
+    longest_path = max(self.tail_lengths(order), default = -1)
+    return max(longest_path + 1, len(set(self.managers)))
+
+  def cost(self, positions: Sequence[int], manager_costs: Sequence[float]) -> float:
+    """Total invocation cost of a layering: each step costs as much as one invocation of its manager."""
+    manager_for_position = {position: self.managers[node] for node, position in enumerate(positions)}
+    return sum(manager_costs[manager] for manager in manager_for_position.values())
+
+  def cost_lower_bound(self, manager_costs: Sequence[float]) -> float:
+    """Minimum invocation cost of any valid install order: each manager needs at least as many steps as
+    manager_step_lower_bounds() states, and each step of the longest path costs at least as much as the cheapest
+    manager."""
+    order = self.topological_order()
+    assert order is not None, "lower bound is only defined for acyclic graphs"
+    manager_steps = self.manager_step_lower_bounds(order)
+    longest_path = max(self.tail_lengths(order), default = -1)
+    cheapest = min((manager_costs[manager] for manager in manager_steps), default = 0)
+    return max(sum(manager_costs[manager] * steps for manager, steps in manager_steps.items()), (longest_path + 1) * cheapest)
+
+  def manager_step_lower_bounds(self, order: Sequence[int]) -> dict[int, int]:
+    """Minimum number of steps of each manager in any valid install order: along each path, two nodes of the same
+    manager have to be installed in separate steps if the path between them contains a weighted edge. Requires a
+    topological order."""
+    predecessors = self.predecessors()
+    result: dict[int, int] = {}
+    for manager in set(self.managers):
+      steps_until = [0] * self.size  # steps of the manager up to and including the node's step
+      steps_before = [0] * self.size  # steps of the manager strictly before the node's step
+      for node in order:
+        steps_before[node] = max((steps_until[other] if weight > 0 else steps_before[other] for other, weight in predecessors[node].items()), default = 0)
+        steps_until[node] = max([steps_before[node] + (1 if self.managers[node] == manager else 0), *(steps_until[other] for other in predecessors[node])])
+      result[manager] = max(steps_until, default = 0)
+    return result
+
+  def transitive_reduction(self) -> InstallGraph:
+    """Returns a copy of the graph without redundant edges. An edge (u, v) with weight w is redundant if there is
+    another path from u to v with a total weight of at least w. Graphs with cycles are returned unchanged.
+    (Reachability is tracked as bitsets, separately for paths of weight >= 0 and weight >= 1.)"""
+    order = self.topological_order()
+    if order is None:
+      return InstallGraph(self.managers, self.groups, self.edges, self.naive_constraint_count)
+    successors = self.successors()
+    reachable: list[int] = [0] * self.size  # nodes reachable via any path
+    reachable_with_gap: list[int] = [0] * self.size  # nodes reachable via a path containing at least one weighted edge
+    reduced_edges: dict[tuple[int, int], int] = {}
+    for node in reversed(order):
+      via_any_path = 0
+      via_path_with_gap = 0
+      for other, weight in successors[node].items():
+        via_any_path |= reachable[other]
+        via_path_with_gap |= reachable[other] if weight > 0 else reachable_with_gap[other]
+      for other, weight in successors[node].items():
+        alternatives = via_path_with_gap if weight > 0 else via_any_path
+        if not (alternatives >> other) & 1:
+          reduced_edges[(node, other)] = weight
+      reachable[node] = via_any_path
+      reachable_with_gap[node] = via_path_with_gap
+      for other, weight in successors[node].items():
+        reachable[node] |= 1 << other
+        if weight > 0:
+          reachable_with_gap[node] |= 1 << other
+    return InstallGraph(self.managers, self.groups, reduced_edges, self.naive_constraint_count)
+
+  def strongly_connected_components(self) -> list[list[int]]:
+    """Tarjan's algorithm (iterative, to avoid hitting the recursion limit on large configs)."""
+    successors = [list(successors) for successors in self.successors()]
+    index_counter = 0
+    indices: list[int | None] = [None] * self.size
+    lowlinks: list[int] = [0] * self.size
+    on_stack: list[bool] = [False] * self.size
+    stack: list[int] = []
+    result: list[list[int]] = []
+    for root in range(self.size):
+      if indices[root] is not None:
+        continue
+      work: list[tuple[int, int]] = [(root, 0)]
+      while work:
+        node, child_idx = work.pop()
+        if child_idx == 0:
+          indices[node] = lowlinks[node] = index_counter
+          index_counter += 1
+          stack.append(node)
+          on_stack[node] = True
+        recurse = False
+        for idx in range(child_idx, len(successors[node])):
+          other = successors[node][idx]
+          other_index = indices[other]
+          if other_index is None:
+            work.append((node, idx + 1))
+            work.append((other, 0))
+            recurse = True
+            break
+          elif on_stack[other]:
+            lowlinks[node] = min(lowlinks[node], other_index)
+        if recurse:
+          continue
+        if lowlinks[node] == indices[node]:
+          component: list[int] = []
+          while True:
+            other = stack.pop()
+            on_stack[other] = False
+            component.append(other)
+            if other == node:
+              break
+          result.append(component)
+        if work:
+          parent = work[-1][0]
+          lowlinks[parent] = min(lowlinks[parent], lowlinks[node])
+    return result
+
+  def find_infeasible_cycle(self) -> list[int] | None:
+    """Searches for a cycle containing at least one weighted edge - such a cycle can never be satisfied. Returns
+    the shortest one (in order), or None if there is none. Within a cycle, items of the same group may be connected
+    directly instead of through the chain of their group, so only the items actually involved get reported."""
+    predecessors = self.predecessors()
+    shortest: list[int] | None = None
+    for component in self.strongly_connected_components():
+      members = set(component)
+      if len(component) == 1 and predecessors[component[0]].get(component[0], 0) == 0:
+        continue
+
+      # connect all members of the same group pairwise (as the solver sees them) to find the shortest cycle
+      successors: dict[int, dict[int, int]] = {node: {} for node in component}
+      for (node1, node2), weight in self.edges.items():
+        if node1 in members and node2 in members:
+          successors[node1][node2] = weight
+      for group in self.groups:
+        group_members = [node for node in group if node in members]
+        for idx1, node1 in enumerate(group_members):
+          for node2 in group_members[idx1 + 1:]:
+            if node1 != node2:
+              weight = 1 if self.managers[node1] != self.managers[node2] else 0
+              successors[node1][node2] = max(weight, successors[node1].get(node2, 0))
+
+      # breadth-first search from each member for the shortest way back, tracking whether a weighted edge was used
+      for start in sorted(component):
+        parents: dict[tuple[int, bool], tuple[int, bool] | None] = {(start, False): None}
+        queue: list[tuple[int, bool]] = [(start, False)]
+        cycle_end: tuple[int, bool] | None = None
+        while queue and cycle_end is None:
+          next_queue: list[tuple[int, bool]] = []
+          for node, has_gap in queue:
+            for other, weight in sorted(successors[node].items()):
+              state = (other, has_gap or weight > 0)
+              if other == start and state[1]:
+                cycle_end = (node, has_gap)
+                break
+              if other != start and state not in parents:
+                parents[state] = (node, has_gap)
+                next_queue.append(state)
+            if cycle_end is not None:
+              break
+          queue = next_queue
+        if cycle_end is None:
+          continue
+        cycle: list[int] = []
+        current: tuple[int, bool] | None = cycle_end
+        while current is not None:
+          cycle.append(current[0])
+          current = parents[current]
+        cycle.reverse()
+        if shortest is None or len(cycle) < len(shortest):
+          shortest = cycle
+    return shortest
+
+  def greedy_layers(self, manager_costs: Sequence[float] | None = None) -> list[int] | None:
+    """Assigns a step index to each node by peeling off layers Kahn-style. Each layer is filled greedily with
+    all items of a single manager that are available at that point. The manager is chosen by the longest
+    remaining path among its available items (so the critical path gets processed first), then by the number of
+    available items and finally by manager index to keep the result deterministic.
+    If manager costs are given, the cheapest available manager is chosen first instead, so expensive managers
+    are postponed until as many of their items as possible have become available.
+    Returns None if the graph contains a cycle."""
+    order = self.topological_order()
+    if order is None:
+      return None
+    successors = self.successors()
+    tails = self.tail_lengths(order)
+    unplaced_predecessors = [0] * self.size
+    for (node1, node2) in self.edges:
+      unplaced_predecessors[node2] += 1
+
+    positions = [-1] * self.size
+    available = {node for node in range(self.size) if unplaced_predecessors[node] == 0}
+    layer = 0
+    while available:
+      available_by_manager: dict[int, list[int]] = defaultdict(list)
+      for node in available:
+        available_by_manager[self.managers[node]].append(node)
+      manager = min(available_by_manager.keys(), key = lambda m: (
+        manager_costs[m] if manager_costs is not None else 0,
+        -max(tails[node] for node in available_by_manager[m]),
+        -len(available_by_manager[m]),
+        m,
+      ))
+
+      # fill the layer, including items that become available through zero-weight edges from this very layer
+      queue = sorted(available_by_manager[manager])
+      blocked: set[int] = set()
+      while queue:
+        node = queue.pop()
+        available.discard(node)
+        positions[node] = layer
+        for other, weight in successors[node].items():
+          unplaced_predecessors[other] -= 1
+          if weight > 0:
+            blocked.add(other)
+          if unplaced_predecessors[other] == 0:
+            if self.managers[other] == manager and other not in blocked:
+              queue.append(other)
+            else:
+              available.add(other)
+      layer += 1
+
+    return positions
+
+  def is_valid_layering(self, positions: Sequence[int]) -> bool:
+    """Checks that the given step indices satisfy all constraints and that no step mixes managers."""
+    if len(positions) != self.size or any(position < 0 for position in positions):
+      return False
+    for (node1, node2), weight in self.edges.items():
+      if positions[node2] - positions[node1] < weight:
+        return False
+    manager_for_position: dict[int, int] = {}
+    for node, position in enumerate(positions):
+      if manager_for_position.setdefault(position, self.managers[node]) != self.managers[node]:
+        return False
+    return True
+
+
+def merge_manager_sequences(sequences: Sequence[Sequence[int]], manager_costs: Sequence[float]) -> tuple[list[int], list[list[int]]]:
+  """Merges the steps of independently layered components into a single sequence of managers, so that steps of
+  the same manager get shared wherever possible. Sequences are merged pairwise (longest first), each time via the
+  cheapest common supersequence (i.e. the shortest one, weighted by manager costs). Returns the merged sequence
+  and, for each input sequence, the merged index of each of its steps."""
+  order = sorted(range(len(sequences)), key = lambda idx: (-len(sequences[idx]), idx))
+  merged: list[int] = []
+  mappings: list[list[int]] = [[] for _ in sequences]
+  for seq_idx in order:
+    sequence = sequences[seq_idx]
+    n, m = len(merged), len(sequence)
+
+    # costs[i][j] = cost of the cheapest common supersequence of merged[i:] and sequence[j:]
+    costs = [[0.0] * (m + 1) for _ in range(n + 1)]
+    for i in range(n, -1, -1):
+      for j in range(m, -1, -1):
+        if i == n and j == m:
+          costs[i][j] = 0.0
+        elif j == m:
+          costs[i][j] = manager_costs[merged[i]] + costs[i + 1][j]
+        elif i == n:
+          costs[i][j] = manager_costs[sequence[j]] + costs[i][j + 1]
+        elif merged[i] == sequence[j]:
+          costs[i][j] = manager_costs[merged[i]] + costs[i + 1][j + 1]
+        else:
+          costs[i][j] = min(manager_costs[merged[i]] + costs[i + 1][j], manager_costs[sequence[j]] + costs[i][j + 1])
+
+    result: list[int] = []
+    merged_map: list[int] = []
+    sequence_map: list[int] = []
+    i = j = 0
+    while i < n or j < m:
+      if i < n and j < m and merged[i] == sequence[j]:
+        merged_map.append(len(result))
+        sequence_map.append(len(result))
+        result.append(merged[i])
+        i, j = i + 1, j + 1
+      elif j == m or (i < n and manager_costs[merged[i]] + costs[i + 1][j] <= manager_costs[sequence[j]] + costs[i][j + 1]):
+        merged_map.append(len(result))
+        result.append(merged[i])
+        i += 1
+      else:
+        sequence_map.append(len(result))
+        result.append(sequence[j])
+        j += 1
+
+    mappings = [[merged_map[position] for position in mapping] for mapping in mappings]
+    mappings[seq_idx] = sequence_map
+    merged = result
+  return merged, mappings
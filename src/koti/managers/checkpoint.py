@@ -15,6 +15,7 @@ class CheckpointState(ConfigItemState):
 class CheckpointManager(ConfigManager[Checkpoint, CheckpointState]):
   managed_classes = [Checkpoint]
   cleanup_order: float = 0
+  invocation_cost: float = 0.1
   managed_Checkpoints_store: JsonCollection[str]
 
   def assert_installable(self, item: Checkpoint, model: ConfigModel):
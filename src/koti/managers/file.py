@@ -1,17 +1,16 @@
 from __future__ import annotations
 
 import os
-import pwd
 import shutil
 from hashlib import sha256
-from pwd import getpwnam, getpwuid
 from typing import Generator, Sequence
 
 from koti import ManagedConfigItem
 from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, SystemState
 from koti.items.file import File
 from koti.items.directory import Directory
-from koti.utils.shell import shell
+from koti.utils.accounts import AccountDatabase, account_database
+from koti.utils.shell import run
 from koti.utils.json_store import JsonCollection, JsonStore
 
 
@@ -51,12 +50,14 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
   cleanup_order = 10
   default_permissions = 0o644
   default_owner  = "root"
+  accounts: AccountDatabase
 
   def __init__(self):
     super().__init__()
     store = JsonStore("/var/cache/koti/FileManager.json")
     self.managed_files_store = store.collection("managed_files")
     self.managed_dirs_store = store.collection("managed_dirs")
+    self.accounts = account_database
 
   def assert_installable(self, item: File | Directory, model: ConfigModel):
     if isinstance(item, File):
@@ -89,7 +90,7 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
     if systemd_daemon_reload:
       yield Action(
         description = "systemctl daemon-reload due to changed systemd files",
-        execute = lambda: shell("systemctl daemon-reload"),
+        execute = lambda: run(["systemctl", "daemon-reload"]),
       )
 
   def get_cleanup_actions(self, items_to_keep: Sequence[File | Directory], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
@@ -134,8 +135,8 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
       os.unlink(tmpfile)
     with open(tmpfile, "wb+") as fh:
       fh.write(target.content)
-      pwnam = getpwnam(target.owner)
-      os.chown(fh.name, uid = pwnam.pw_uid, gid = pwnam.pw_gid)
+      pwnam = self.accounts.user(target.owner)
+      os.chown(fh.name, uid = pwnam.uid, gid = pwnam.gid)
       os.chmod(fh.name, mode = target.mode)
     return f"preview content changes: diff '{item.filename}' '{tmpfile}'"
 
@@ -215,14 +216,14 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
 
   def create_or_update_file(self, item: File, current: FileState | None, target: FileState, register_file: bool):
     assert item.content is not None
-    pwnam = getpwnam(target.owner)
+    pwnam = self.accounts.user(target.owner)
     mode = target.mode
     content = target.content
     owner = item.owner or self.default_owner
     self.mkdirs(os.path.dirname(item.filename), owner)
     with open(item.filename, 'wb+') as fh:
       fh.write(content)  # type: ignore
-    os.chown(item.filename, uid = pwnam.pw_uid, gid = pwnam.pw_gid)
+    os.chown(item.filename, uid = pwnam.uid, gid = pwnam.gid)
     os.chmod(item.filename, mode)
     assert mode == (os.stat(item.filename).st_mode & 0o777), "cannot apply file permissions (incompatible file system?)"
     if register_file:
@@ -230,8 +231,8 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
     print(f"file {item.filename} successfully {"updated" if current is not None else "created"}")
 
   def fix_file_owner(self, item: File, target: FileState, register_file: bool):
-    pwnam = getpwnam(target.owner)
-    os.chown(item.filename, uid = pwnam.pw_uid, gid = pwnam.pw_gid)
+    pwnam = self.accounts.user(target.owner)
+    os.chown(item.filename, uid = pwnam.uid, gid = pwnam.gid)
     if register_file:
       self.managed_files_store.add(item.filename)
     print(f"file owner of {item.filename} successfully updated")
@@ -250,7 +251,7 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
     stat = os.stat(item.filename)
     return FileState(
       content = content,
-      owner = getpwuid(stat.st_uid).pw_name,
+      owner = self.accounts.user_by_uid(stat.st_uid).name,
       mode = stat.st_mode & 0o777,
     )
 
@@ -284,8 +285,8 @@ class FileManager(ConfigManager[File | Directory, FileState | DirectoryState]):
     if not os.path.exists(os.path.dirname(dirname)):
       self.mkdirs(os.path.dirname(dirname), owner)
     os.mkdir(dirname)
-    getpwnam = pwd.getpwnam(owner)
-    os.chown(dirname, uid = getpwnam.pw_uid, gid = getpwnam.pw_gid)
+    pwnam = self.accounts.user(owner)
+    os.chown(dirname, uid = pwnam.uid, gid = pwnam.gid)
 
   def finalize(self, model: ConfigModel, dryrun: bool):
     if not dryrun:
@@ -1,10 +1,10 @@
 from hashlib import sha256
-import re
 from typing import Generator, Sequence
 
 from koti import Action
 from koti.utils.logging import logger
-from koti.utils.shell import shell, shell_output, shell_success
+from koti.utils.flatpak import FlatpakInventory, flatpak_inventory
+from koti.utils.shell import run
 from koti.items.flatpak_package import FlatpakPackage
 from koti.model import ConfigItemState, ConfigManager, ConfigModel, SystemState
 from koti.items.flatpak_repo import FlatpakRepo
@@ -28,24 +28,31 @@ class FlatpakPackageState(ConfigItemState):
 class FlatpakPackageManager(ConfigManager[FlatpakPackage, FlatpakRepoState | FlatpakPackageState]):
   managed_classes = [FlatpakPackage]
   cleanup_order = 20
+  invocation_cost = 5.0
 
   def assert_installable(self, item: FlatpakPackage, model: ConfigModel):
     pass
 
+  inventory: FlatpakInventory
+
   def __init__(self, perform_update: bool = False):
     super().__init__()
     self.perform_update = perform_update
+    self.inventory = flatpak_inventory
+
+  def initialize(self, model: ConfigModel, dryrun: bool):
+    self.inventory.invalidate()
 
   def get_state(self, item: FlatpakPackage, system_state: SystemState) -> FlatpakPackageState | None:
-    flatpak_available = shell_success("flatpak --version")
-    if not flatpak_available:
-      return None
     installed = self.is_package_installed(item.id)
     return FlatpakPackageState() if installed else None
 
+  def get_states(self, items: Sequence[FlatpakPackage], system_state: SystemState) -> dict[FlatpakPackage, FlatpakRepoState | FlatpakPackageState | None]:
+    installed_packages = self.inventory.installed_apps()
+    return {item: FlatpakPackageState() if item.id in installed_packages else None for item in items}
+
   def get_install_actions(self, items_to_check: Sequence[FlatpakPackage], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    flatpak_available = shell_success("flatpak --version")
-    if not flatpak_available:
+    if not self.inventory.available():
       logger.error("could not accurately plan installation/cleanup of flatpak repos + packages due to (currently) missing flatpak installation")
     if items_to_check:
       items_to_install: list[FlatpakPackage] = []
@@ -59,43 +66,57 @@ class FlatpakPackageManager(ConfigManager[FlatpakPackage, FlatpakRepoState | Fla
         yield Action(
           installs = {item: FlatpakPackageState() for item in items_to_install},
           description = f"install flatpak(s): {", ".join(item.id for item in items_to_install)}",
-          execute = lambda: shell(f"flatpak --system install --system {" ".join(item.id for item in items_to_install)}"),
+          execute = lambda: self.run_and_invalidate(["flatpak", "--system", "install", *(item.id for item in items_to_install)]),
         )
 
   def get_cleanup_actions(self, items_to_keep: Sequence[FlatpakPackage], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    flatpak_available = shell_success("flatpak --version")
-    if not flatpak_available:
+    if not self.inventory.available():
       if model.contains(lambda item: isinstance(item, FlatpakPackage) or isinstance(item, FlatpakRepo)):
         logger.error("could not accurately plan installation/cleanup of flatpak repos + packages due to (currently) missing flatpak installation")
       return
 
-    installed_packages = [FlatpakPackage(name) for name in shell_output("flatpak list --app --columns application").splitlines()]
+    installed_packages = [FlatpakPackage(name) for name in sorted(self.inventory.installed_apps())]
     packages_to_remove = [item for item in installed_packages if item not in items_to_keep]
     if packages_to_remove:
       yield Action(
         removes = packages_to_remove,
         description = f"uninstall flatpak(s): {", ".join(item.id for item in packages_to_remove)}",
-        execute = lambda: shell(f"flatpak --system uninstall {" ".join(item.id for item in packages_to_remove)}"),
+        execute = lambda: self.run_and_invalidate(["flatpak", "--system", "uninstall", *(item.id for item in packages_to_remove)]),
       )
 
     if self.perform_update:
       yield Action(
         description = f"update all flatpak packages",
-        execute = lambda: shell(f"flatpak --system update"),
+        execute = lambda: self.run_and_invalidate(["flatpak", "--system", "update"]),
       )
 
     yield Action(
       description = f"prune unneeded flatpak runtimes",
-      execute = lambda: shell(f"flatpak --system uninstall --unused"),
+      execute = lambda: self.run_and_invalidate(["flatpak", "--system", "uninstall", "--unused"]),
     )
 
   def is_package_installed(self, package: str) -> bool:
-    return package in shell_output("flatpak --system list --app --columns application").splitlines()
+    return package in self.inventory.installed_apps()
+
+  def run_and_invalidate(self, argv: list[str]):
+    try:
+      run(argv)
+    finally:
+      self.inventory.invalidate()
 
 
 class FlatpakRepoManager(ConfigManager[FlatpakRepo, FlatpakRepoState]):
   managed_classes = [FlatpakRepo]
   cleanup_order = 20
+  invocation_cost = 2.0
+  inventory: FlatpakInventory
+
+  def __init__(self):
+    super().__init__()
+    self.inventory = flatpak_inventory
+
+  def initialize(self, model: ConfigModel, dryrun: bool):
+    self.inventory.invalidate()
 
   def assert_installable(self, item: FlatpakRepo, model: ConfigModel):
     if isinstance(item, FlatpakRepo):
@@ -103,18 +124,18 @@ class FlatpakRepoManager(ConfigManager[FlatpakRepo, FlatpakRepoState]):
       assert item.repo_url is not None, "missing repo_url"
 
   def get_state(self, item: FlatpakRepo, system_state: SystemState) -> FlatpakRepoState | None:
-    flatpak_available = shell_success("flatpak --version")
-    if not flatpak_available:
-      return None
     url = self.get_installed_repo_url(item)
     return FlatpakRepoState(repo_url = url) if url else None
 
+  def get_states(self, items: Sequence[FlatpakRepo], system_state: SystemState) -> dict[FlatpakRepo, FlatpakRepoState | None]:
+    installed_repo_urls = self.get_installed_repo_urls()
+    return {item: FlatpakRepoState(repo_url = installed_repo_urls[item.name]) if installed_repo_urls.get(item.name, None) else None for item in items}
+
   def get_install_actions(self, items_to_check: Sequence[FlatpakRepo], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    flatpak_available = shell_success("flatpak --version")
-    if not flatpak_available:
+    if not self.inventory.available():
       logger.error("could not accurately plan installation/cleanup of flatpak repos + packages due to (currently) missing flatpak installation")
     if items_to_check:
-      installed_remotes = shell_output("flatpak --system remotes --columns name").splitlines() if flatpak_available else []
+      installed_remotes = self.get_installed_repo_urls().keys()
       for item in items_to_check:
         assert item.repo_url is not None
         current = system_state.get_state(item, system_state, FlatpakRepoState)
@@ -136,29 +157,37 @@ class FlatpakRepoManager(ConfigManager[FlatpakRepo, FlatpakRepoState]):
           )
 
   def get_cleanup_actions(self, items_to_keep: Sequence[FlatpakRepo], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    flatpak_available = shell_success("flatpak --version")
-    if not flatpak_available:
+    if not self.inventory.available():
       if model.contains(lambda item: isinstance(item, FlatpakPackage) or isinstance(item, FlatpakRepo)):
         logger.error("could not accurately plan installation/cleanup of flatpak repos + packages due to (currently) missing flatpak installation")
       return
 
-    installed_repos = [FlatpakRepo(name) for name in shell_output("flatpak --system remotes --columns name").splitlines()]
+    installed_repos = [FlatpakRepo(name) for name in self.get_installed_repo_urls().keys()]
     repos_to_remove = [item for item in installed_repos if item not in items_to_keep]
     for item in repos_to_remove:
       yield Action(
         removes = [item],
         description = f"uninstall flatpak remote: {item.name}",
-        execute = lambda: shell(f"flatpak --system remote-delete --force '{item.name}'"),
+        execute = lambda: self.delete_remote(item),
       )
 
   def update_remote(self, item: FlatpakRepo, remove_existing: bool):
-    if remove_existing:
-      shell(f"flatpak --system remote-delete --force '{item.name}'")
-    shell(f"flatpak --system remote-add '{item.name}' '{item.spec_url}'")
+    try:
+      if remove_existing:
+        run(["flatpak", "--system", "remote-delete", "--force", item.name])
+      assert item.spec_url is not None
+      run(["flatpak", "--system", "remote-add", item.name, item.spec_url])
+    finally:
+      self.inventory.invalidate()
+
+  def delete_remote(self, item: FlatpakRepo):
+    try:
+      run(["flatpak", "--system", "remote-delete", "--force", item.name])
+    finally:
+      self.inventory.invalidate()
 
   def get_installed_repo_url(self, item: FlatpakRepo) -> str | None:
-    for line in shell_output("flatpak --system remotes --columns name,url").splitlines():
-      split = re.split("\\s+", line)
-      if split[0] == item.name:
-        return split[1]
-    return None
+    return self.get_installed_repo_urls().get(item.name, None)
+
+  def get_installed_repo_urls(self) -> dict[str, str]:
+    return self.inventory.remote_urls()
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import shlex
+
 from koti.model import *
 from koti.items.package import Package
 from koti.utils.json_store import JsonCollection, JsonStore
 from koti.utils.logging import logger
-from koti.utils.shell import shell, shell_output
+from koti.utils.pacman_db import PacmanLocalDb
+from koti.utils.shell import run, run_output
 
 
 class PackageState(ConfigItemState):
@@ -24,10 +27,14 @@ class AurHelper:
 class PacmanPackageManager(ConfigManager[Package, PackageState]):
   managed_classes = [Package]
   cleanup_order = 70
+  invocation_cost = 10.0  # each step runs a full system upgrade
   ignore_manually_installed_packages: bool
   managed_packages_store: JsonCollection[str]
-  explicit_packages_on_system: set[str]  # holds the list of explicitly installed packages on the system; will be updated whenever the manager adds/removes explicit packages.
+  installed_packages_on_system: set[str]  # index of all installed packages; updated by each action of the manager
+  explicit_packages_on_system: set[str]  # index of explicitly installed packages; updated by each action of the manager
+  package_index_stale: bool  # set while packages get installed/removed (or if the effects are unknown), so the index gets reloaded on next access
   aur_helper: AurHelper | None
+  local_db: PacmanLocalDb
 
   def __init__(
     self,
@@ -40,11 +47,14 @@ class PacmanPackageManager(ConfigManager[Package, PackageState]):
     self.aur_helper = aur_helper
     self.managed_packages_store = store.collection("managed_packages")
     self.ignore_manually_installed_packages = keep_unmanaged_packages
+    self.installed_packages_on_system = set()
     self.explicit_packages_on_system = set()
+    self.package_index_stale = True
     self.perform_update = perform_update
+    self.local_db = PacmanLocalDb()
 
   def initialize(self, model: ConfigModel, dryrun: bool):
-    self.explicit_packages_on_system = set(self.pacman_list_explicit_packages())
+    self.reconcile_package_index()
 
   def finalize(self, model: ConfigModel, dryrun: bool):
     if not dryrun:
@@ -55,7 +65,7 @@ class PacmanPackageManager(ConfigManager[Package, PackageState]):
     pass
 
   def get_state(self, item: Package, system_state: SystemState) -> PackageState | None:
-    installed: bool = item.name in self.explicit_packages_on_system
+    installed: bool = item.name in self.explicit_package_names()
     return PackageState() if installed else None
 
   def reorder_for_install(self, items: Sequence[Package]) -> list[Package]:
@@ -66,8 +76,9 @@ class PacmanPackageManager(ConfigManager[Package, PackageState]):
     ]
 
   def get_install_actions(self, items_to_check: Sequence[Package], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    installed_packages = self.pacman_list_installed_packages()
-    explicit_packages = self.pacman_list_explicit_packages()
+    self.reconcile_package_index()
+    installed_packages = self.installed_package_names()
+    explicit_packages = self.explicit_package_names()
 
     additional_explicit_items: list[Package] = []
     additional_items_from_script: list[Package] = []
@@ -131,25 +142,27 @@ class PacmanPackageManager(ConfigManager[Package, PackageState]):
   def install_from_repo(self, additional_items_from_repo: list[Package]):
     pacman_or_helper = self.aur_helper.command if self.aur_helper else "pacman"
     user = self.aur_helper.user if self.aur_helper else None
-    shell(f"{pacman_or_helper} -Syu {" ".join([item.name for item in additional_items_from_repo])}", user = user)
+    self.package_index_stale = True  # -Syu also upgrades packages and installs dependencies
+    run([*shlex.split(pacman_or_helper), "-Syu", *(item.name for item in additional_items_from_repo)], user = user)
     self.add_managed_packages(additional_items_from_repo)
-    self.update_explicit_package_list()
+    self.reconcile_package_index()
 
   def install_from_url(self, additional_items_from_urls: list[Package]):
-    shell(f"pacman -U --asexplicit {" ".join([item.url for item in additional_items_from_urls if item.url])}")
+    self.package_index_stale = True  # -U also installs missing dependencies
+    run(["pacman", "-U", "--asexplicit", *(item.url for item in additional_items_from_urls if item.url)])
     self.add_managed_packages(additional_items_from_urls)
-    self.update_explicit_package_list()
+    self.reconcile_package_index()
 
   def install_from_script(self, item: Package):
     assert item.script is not None, "illegal state"
+    self.package_index_stale = True  # the effects of a script are unknown, so the index gets reloaded lazily
     item.script()
     self.add_managed_packages([item])
-    self.update_explicit_package_list()
 
   def mark_explicit(self, additional_explicit_items: list[Package]):
-    shell(f"pacman -D --asexplicit {" ".join([item.name for item in additional_explicit_items])}")
+    run(["pacman", "-D", "--asexplicit", *(item.name for item in additional_explicit_items)])
     self.add_managed_packages(additional_explicit_items)
-    self.update_explicit_package_list()
+    self.update_package_index(explicit = additional_explicit_items)
 
   def get_cleanup_actions(self, items_to_keep: Sequence[Package], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
     installed_items = self.installed_packages()
@@ -173,19 +186,40 @@ class PacmanPackageManager(ConfigManager[Package, PackageState]):
     )
 
   def mark_dependency(self, items_to_remove: list[Package]):
-    shell(f"pacman -D --asdeps {" ".join([item.name for item in items_to_remove])}")
+    run(["pacman", "-D", "--asdeps", *(item.name for item in items_to_remove)])
     self.remove_managed_packages(items_to_remove)
+    self.update_package_index(dependency = items_to_remove)
 
   def installed_packages(self) -> list[Package]:
     installed_by_koti = self.managed_packages_store.elements()
     package_names = {
-      pkg for pkg in self.explicit_packages_on_system
+      pkg for pkg in self.explicit_package_names()
       if not self.ignore_manually_installed_packages or pkg in installed_by_koti
     }
     return [Package(pkg) for pkg in package_names]
 
-  def update_explicit_package_list(self):
+  def installed_package_names(self) -> set[str]:
+    if self.package_index_stale:
+      self.reconcile_package_index()
+    return self.installed_packages_on_system
+
+  def explicit_package_names(self) -> set[str]:
+    if self.package_index_stale:
+      self.reconcile_package_index()
+    return self.explicit_packages_on_system
+
+  def reconcile_package_index(self):
+    """Reloads the package index from the pacman database."""
+    self.installed_packages_on_system = set(self.pacman_list_installed_packages())
     self.explicit_packages_on_system = set(self.pacman_list_explicit_packages())
+    self.package_index_stale = False
+
+  def update_package_index(self, explicit: Sequence[Package] = (), dependency: Sequence[Package] = ()):
+    """Applies the effects of a successful `pacman -D` to the package index, so it doesn't have to be reloaded. Only
+    valid for actions whose effects are fully known, anything that installs or upgrades packages has to reload it.
+    If the index is already stale, it stays that way: only reconcile_package_index() clears the flag."""
+    self.explicit_packages_on_system.update(item.name for item in explicit)
+    self.explicit_packages_on_system.difference_update(item.name for item in dependency)
 
   def add_managed_packages(self, items: list[Package]):
     self.managed_packages_store.add_all([item.name for item in items])
@@ -194,22 +228,28 @@ class PacmanPackageManager(ConfigManager[Package, PackageState]):
     self.managed_packages_store.remove_all([item.name for item in items])
 
   def pacman_list_explicit_packages(self) -> list[str]:
-    return self.parse_pkgs(shell_output(f"pacman -Qqe", check = False))
+    if self.local_db.available():
+      return sorted(self.local_db.explicit_packages())
+    return self.parse_pkgs(run_output(["pacman", "-Qqe"], check = False))
 
   def pacman_list_installed_packages(self) -> list[str]:
-    return self.parse_pkgs(shell_output(f"pacman -Qq", check = False))
+    if self.local_db.available():
+      return sorted(self.local_db.installed_packages())
+    return self.parse_pkgs(run_output(["pacman", "-Qq"], check = False))
 
   def pacman_prune_unneeded(self):
-    unneeded_packages = self.parse_pkgs(shell_output(f"pacman -Qdttq", check = False))
+    unneeded_packages = self.parse_pkgs(run_output(["pacman", "-Qdttq"], check = False))
     if len(unneeded_packages) > 0:
-      shell(f"pacman -Rns {" ".join(unneeded_packages)}")
+      self.package_index_stale = True  # -Rns also removes dependencies of the unneeded packages
+      run(["pacman", "-Rns", *unneeded_packages])
     else:
       print("no unneeded packages found")
 
   def update_all_packages(self):
     pacman_or_helper = self.aur_helper.command if self.aur_helper else "pacman"
     user = self.aur_helper.user if self.aur_helper else None
-    shell(f"{pacman_or_helper} -Syu", user = user)
+    self.package_index_stale = True  # upgrades may replace packages
+    run([*shlex.split(pacman_or_helper), "-Syu"], user = user)
 
   def parse_pkgs(self, output: str) -> list[str]:
     if "there is nothing to do" in output: return []
@@ -2,7 +2,8 @@ from __future__ import annotations
 
 from koti.model import *
 from koti.items.pacman_key import PacmanKey
-from koti.utils.shell import shell, shell_success
+from koti.utils.pacman_keyring import PacmanKeyring
+from koti.utils.shell import run
 
 
 class PacmanKeyState(ConfigItemState):
@@ -13,30 +14,50 @@ class PacmanKeyState(ConfigItemState):
 class PacmanKeyManager(ConfigManager[PacmanKey, PacmanKeyState]):
   managed_classes = [PacmanKey]
   cleanup_order = 70
+  invocation_cost = 3.0
+  keyring: PacmanKeyring
+
+  def __init__(self):
+    super().__init__()
+    self.keyring = PacmanKeyring()
+
+  def initialize(self, model: ConfigModel, dryrun: bool):
+    self.keyring.invalidate()
 
   def assert_installable(self, item: PacmanKey, model: ConfigModel):
     pass
 
   def get_state(self, item: PacmanKey, system_state: SystemState) -> PacmanKeyState | None:
-    installed: bool = shell_success(f"pacman-key --list-keys | grep {item.key_id}")
-    return PacmanKeyState() if installed else None
+    return PacmanKeyState() if self.keyring.contains(item.key_id) else None
+
+  def get_states(self, items: Sequence[PacmanKey], system_state: SystemState) -> dict[PacmanKey, PacmanKeyState | None]:
+    keys = self.keyring.keys()  # a single snapshot for all items
+    return {item: PacmanKeyState() if self.keyring.is_contained(item.key_id, keys) else None for item in items}
 
   def get_install_actions(self, items_to_check: Sequence[PacmanKey], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
+    items_to_install: list[PacmanKey] = []
     for item in items_to_check:
       current = system_state.get_state(item, system_state, PacmanKeyState)
       target = PacmanKeyState()
       if current == target:
         continue
+      items_to_install.append(item)
+    if items_to_install:
       yield Action(
-        installs = {item: target},
-        description = f"install pacman-key {item.key_id} from {item.key_server}",
-        execute = lambda: self.add_key(item),
+        installs = {item: PacmanKeyState() for item in items_to_install},
+        description = f"install pacman-key(s) {", ".join(item.key_id for item in items_to_install)}",
+        additional_info = [f"{item.key_id} from {item.key_server}" for item in items_to_install],
+        execute = lambda: self.add_keys(items_to_install),
       )
 
-  def add_key(self, item: PacmanKey):
-    shell(f"pacman-key --init")
-    shell(f"pacman-key --recv-keys {item.key_id} --keyserver {item.key_server}")
-    shell(f"pacman-key --lsign-key {item.key_id}")
+  def add_keys(self, items: list[PacmanKey]):
+    try:
+      run(["pacman-key", "--init"])
+      for key_server in dict.fromkeys(item.key_server for item in items):
+        run(["pacman-key", "--recv-keys", *(item.key_id for item in items if item.key_server == key_server), "--keyserver", key_server])
+      run(["pacman-key", "--lsign-key", *(item.key_id for item in items)])
+    finally:
+      self.keyring.invalidate()
 
   def get_cleanup_actions(self, items_to_keep: Sequence[PacmanKey], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
     yield from ()
@@ -1,11 +1,32 @@
+import fcntl
 import os.path
+import re
+import struct
 from hashlib import sha256
 from typing import Generator, Sequence
 
 from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, SystemState
 from koti.items.swapfile import Swapfile
 from koti.utils.json_store import JsonCollection, JsonStore
-from koti.utils.shell import shell, shell_success
+from koti.utils.shell import run
+
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_NOCOW_FL = 0x00800000
+
+
+def read_active_swaps(path: str = "/proc/swaps") -> list[str]:
+  """Returns the filenames of all active swap areas. The kernel escapes whitespace and backslashes in
+  filenames as octal sequences (e.g. "\\040" for a space)."""
+  try:
+    with open(path, "r") as file:
+      lines = file.read().splitlines()[1:]  # skip header
+  except FileNotFoundError:
+    return []
+  return [
+    re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), line.split()[0])
+    for line in lines if line.strip()
+  ]
 
 
 class SwapfileState(ConfigItemState):
@@ -32,30 +53,72 @@ class SwapfileManager(ConfigManager[Swapfile, SwapfileState]):
     assert item.size_bytes is not None, "missing size_bytes parameter"
 
   def create_swapfile(self, item: Swapfile):
-    shell(f"mkswap -U clear --size {item.size_bytes} --file {item.filename}")
-    shell(f"chmod 600 {item.filename}")
+    assert item.size_bytes is not None
+    if not self.allocate_swapfile(item.filename, item.size_bytes, create = True):
+      if os.path.exists(item.filename):
+        os.unlink(item.filename)
+      run(["mkswap", "-U", "clear", "--size", str(item.size_bytes), "--file", item.filename])
+    else:
+      run(["mkswap", "-U", "clear", item.filename])
+    os.chmod(item.filename, 0o600)
     self.managed_files_store.add(item.filename)
 
   def recreate_swapfile(self, item: Swapfile):
-    if self.is_mounted(item.filename):
-      shell(f"swapoff {item.filename}")
-      os.unlink(item.filename)
-      self.create_swapfile(item)
-      shell(f"swapon {item.filename}")
+    assert item.size_bytes is not None
+    mounted = self.is_mounted(item.filename)
+    if mounted:
+      run(["swapoff", item.filename])
+    if self.allocate_swapfile(item.filename, item.size_bytes, create = False):
+      # resized in place, only the swap header has to be rewritten
+      run(["mkswap", "-U", "clear", item.filename])
+      os.chmod(item.filename, 0o600)
     else:
-      shell(f"rm -f {item.filename}")
+      os.unlink(item.filename)
       self.create_swapfile(item)
+    if mounted:
+      run(["swapon", item.filename])
     self.managed_files_store.add(item.filename)
 
+  def allocate_swapfile(self, filename: str, size_bytes: int, create: bool) -> bool:
+    """Creates or resizes the file with posix_fallocate(), which reserves all blocks without writing them. Swapfiles
+    must not contain holes or be copy-on-write, so new files get the NOCOW flag (required on btrfs) before any
+    blocks are allocated. Returns False if the filesystem doesn't support this, so that mkswap --size can be used."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL if create else os.O_WRONLY
+    try:
+      fd = os.open(filename, flags, 0o600)
+    except OSError:
+      return False
+    try:
+      if create:
+        self.set_nocow(fd)
+      current_size = os.fstat(fd).st_size
+      if size_bytes < current_size:
+        os.ftruncate(fd, size_bytes)
+      else:
+        os.posix_fallocate(fd, 0, size_bytes)
+      os.fsync(fd)
+      return True
+    except OSError:
+      return False
+    finally:
+      os.close(fd)
+
+  def set_nocow(self, fd: int):
+    try:
+      flags = struct.unpack("i", fcntl.ioctl(fd, FS_IOC_GETFLAGS, struct.pack("i", 0)))[0]
+      fcntl.ioctl(fd, FS_IOC_SETFLAGS, struct.pack("i", flags | FS_NOCOW_FL))
+    except OSError:
+      pass  # not supported by the filesystem (and not needed there)
+
   def delete_swapfile(self, item: Swapfile):
     if os.path.isfile(item.filename):
       if self.is_mounted(item.filename):
-        shell(f"swapoff {item.filename}")
+        run(["swapoff", item.filename])
       os.unlink(item.filename)
     self.managed_files_store.remove(item.filename)
 
   def is_mounted(self, swapfile: str) -> bool:
-    return shell_success(f"swapon --show | grep {swapfile}")
+    return os.path.realpath(swapfile) in read_active_swaps()
 
   def get_state(self, item: Swapfile, system_state: SystemState) -> SwapfileState | None:
     if not os.path.isfile(item.filename):
@@ -3,9 +3,9 @@ from typing import Generator, Sequence
 from koti.managers.file import FileManager
 from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, SystemState
 from koti.items.systemd import SystemdUnit
-from koti.managers.pacman import shell
-from koti.utils.shell import shell_success
+from koti.utils.shell import run, run_output, run_success
 from koti.utils.json_store import JsonCollection, JsonStore
+from koti.utils.systemd import ENABLED_UNIT_FILE_STATES, UnitEnablementIndex, systemctl_for_user
 
 
 class SystemdUnitState(ConfigItemState):
@@ -16,22 +16,25 @@ class SystemdUnitState(ConfigItemState):
 class SystemdUnitManager(ConfigManager[SystemdUnit, SystemdUnitState]):
   managed_classes = [SystemdUnit]
   cleanup_order = 30
+  invocation_cost = 2.0
   cleanup_order_before = [FileManager]  # already removed systemd files cause cleanup to fail
   store: JsonStore
+  enablement: UnitEnablementIndex
 
   def __init__(self):
     super().__init__()
     self.store = JsonStore("/var/cache/koti/SystemdUnitManager.json")
+    self.enablement = UnitEnablementIndex()
 
   def assert_installable(self, item: SystemdUnit, model: ConfigModel):
     pass
 
   def install(self, items: list[SystemdUnit], model: ConfigModel):
-    if len(items) > 0: shell(f"systemctl daemon-reload")
+    if len(items) > 0: run(["systemctl", "daemon-reload"])
     users = set([item.user for item in items])
     for username in users:
       items_for_user = [item for item in items if item.user == username]
-      shell(f"{self.systemctl_for_user(username)} enable --now {" ".join([item.name for item in items_for_user])}")
+      run([*self.systemctl_for_user(username), "enable", "--now", *(item.name for item in items_for_user)])
       units_store: JsonCollection[str] = self.store.collection(username or "$system")
       units_store.add_all([item.name for item in items])
 
@@ -44,9 +47,37 @@ class SystemdUnitManager(ConfigManager[SystemdUnit, SystemdUnitState]):
     return result
 
   def get_state(self, item: SystemdUnit, system_state: SystemState) -> SystemdUnitState | None:
-    enabled: bool = shell_success(f"{self.systemctl_for_user(item.user)} is-enabled {item.name}")
+    enabled = self.enablement.is_enabled(item.name, item.user)
+    if enabled is None:
+      enabled = run_success([*self.systemctl_for_user(item.user), "is-enabled", item.name])
     return SystemdUnitState() if enabled else None
 
+  def get_states(self, items: Sequence[SystemdUnit], system_state: SystemState) -> dict[SystemdUnit, SystemdUnitState | None]:
+    result: dict[SystemdUnit, SystemdUnitState | None] = {}
+    for username in dict.fromkeys(item.user for item in items):
+      snapshot = self.enablement.snapshot(username)
+      items_for_user: list[SystemdUnit] = []
+      for item in items:
+        if item.user != username:
+          continue
+        enabled = snapshot.is_enabled(self.enablement.normalize(item.name)) if snapshot is not None else None
+        if enabled is None:
+          items_for_user.append(item)  # not covered by the snapshot, ask systemctl
+        else:
+          result[item] = SystemdUnitState() if enabled else None
+      if not items_for_user:
+        continue
+      unit_file_states = run_output([*self.systemctl_for_user(username), "is-enabled", *(item.name for item in items_for_user)], check = False).splitlines()
+      if len(unit_file_states) != len(items_for_user):
+        # unknown units only produce an error message, so the output can't be matched to the units anymore
+        for item in items_for_user:
+          enabled = run_success([*self.systemctl_for_user(item.user), "is-enabled", item.name])
+          result[item] = SystemdUnitState() if enabled else None
+        continue
+      for item, unit_file_state in zip(items_for_user, unit_file_states):
+        result[item] = SystemdUnitState() if unit_file_state.strip() in ENABLED_UNIT_FILE_STATES else None
+    return result
+
   def get_install_actions(self, items_to_check: Sequence[SystemdUnit], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
     users = {item.user for item in items_to_check}
     for username in users:
@@ -85,18 +116,20 @@ class SystemdUnitManager(ConfigManager[SystemdUnit, SystemdUnitState]):
 
   def deactivate_units(self, username: str | None, items_to_deactivate_for_user: list[SystemdUnit]):
     units_store: JsonCollection[str] = self.store.collection(username or "$system")
-    shell(f"systemctl daemon-reload"),
-    shell(f"{self.systemctl_for_user(username)} disable --now {" ".join([item.name for item in items_to_deactivate_for_user])}"),
+    run(["systemctl", "daemon-reload"])
+    run([*self.systemctl_for_user(username), "disable", "--now", *(item.name for item in items_to_deactivate_for_user)])
+    self.enablement.invalidate(username)
     units_store.remove_all([item.name for item in items_to_deactivate_for_user])
 
   def activate_units(self, username: str | None, items_to_activate_for_user: list[SystemdUnit]):
     units_store: JsonCollection[str] = self.store.collection(username or "$system")
-    shell(f"systemctl daemon-reload")
-    shell(f"{self.systemctl_for_user(username)} enable --now {" ".join([item.name for item in items_to_activate_for_user])}")
+    run(["systemctl", "daemon-reload"])
+    run([*self.systemctl_for_user(username), "enable", "--now", *(item.name for item in items_to_activate_for_user)])
+    self.enablement.invalidate(username)
     units_store.add_all([item.name for item in items_to_activate_for_user])
 
-  def systemctl_for_user(self, user: str | None):
-    return f"systemctl --user -M {user}@" if user is not None else "systemctl"
+  def systemctl_for_user(self, user: str | None) -> list[str]:
+    return systemctl_for_user(user)
 
   def finalize(self, model: ConfigModel, dryrun: bool):
     if not dryrun:
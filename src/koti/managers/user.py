@@ -4,7 +4,8 @@ from hashlib import sha256
 from typing import Generator, Sequence
 
 from koti import Action
-from koti.utils.shell import shell, shell_output
+from koti.utils.accounts import AccountDatabase, account_database
+from koti.utils.shell import run, run_output
 from koti.model import ConfigItemState, ConfigManager, ConfigModel, SystemState
 from koti.items.user import User
 from koti.utils.json_store import JsonCollection, JsonStore
@@ -24,26 +25,34 @@ class UserManager(ConfigManager[User, UserState]):
   managed_classes = [User]
   cleanup_order: float = 80
   managed_users_store: JsonCollection[str]
+  accounts: AccountDatabase
 
   def __init__(self):
     super().__init__()
     store = JsonStore("/var/cache/koti/UserManager.json")
     self.managed_users_store = store.collection("managed_users")
+    self.accounts = account_database
 
   def assert_installable(self, item: User, model: ConfigModel):
     pass
 
   def get_state(self, item: User, system_state: SystemState) -> UserState | None:
-    user_shells: dict[str, str] = dict([line.split(":") for line in shell_output("getent passwd | cut -d: -f1,7").splitlines()])
-    if item.username not in user_shells.keys():
-      return None  # user not in /etc/passwd
-    groups: list[str] = []
-    for line in shell_output("getent group | cut -d: -f1,4").splitlines():
-      [group, users_csv] = line.split(":")
-      if item.username in users_csv.split(","):
-        groups.append(group)
-    pw_status = shell_output(f"passwd --status {item.username}").split(" ")[1]
-    return UserState(has_password = pw_status == "P")
+    return self.get_states([item], system_state)[item]
+
+  def get_states(self, items: Sequence[User], system_state: SystemState) -> dict[User, UserState | None]:
+    users = self.accounts.users()
+    pw_status = self.accounts.password_status()
+    if pw_status is None:
+      # /etc/shadow not readable, `passwd --status --all` lists all users in /etc/shadow
+      pw_status = {}
+      for line in run_output(["passwd", "--status", "--all"]).splitlines():
+        split = line.split(" ")
+        if len(split) > 1:
+          pw_status[split[0]] = split[1]
+    return {
+      item: UserState(has_password = pw_status.get(item.username, None) == "P") if item.username in users else None
+      for item in items
+    }
 
   def get_install_actions(self, items_to_check: Sequence[User], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
     for user in items_to_check:
@@ -85,21 +94,33 @@ class UserManager(ConfigManager[User, UserState]):
       )
 
   def create_user(self, username: str, with_password: bool):
-    shell(f"useradd {username}")
-    if with_password:
-      shell(f"passwd {username}")
+    try:
+      run(["useradd", username])
+      if with_password:
+        run(["passwd", username])
+    finally:
+      self.accounts.invalidate()
     self.managed_users_store.add(username)
 
   def update_password(self, username: str):
-    shell(f"passwd {username}")
+    try:
+      run(["passwd", username])
+    finally:
+      self.accounts.invalidate()
     self.managed_users_store.add(username)
 
   def remove_password(self, username: str):
-    shell(f"passwd --lock {username}")
+    try:
+      run(["passwd", "--lock", username])
+    finally:
+      self.accounts.invalidate()
     self.managed_users_store.add(username)
 
   def delete_user(self, user: User):
-    shell(f"userdel {user.username}")
+    try:
+      run(["userdel", user.username])
+    finally:
+      self.accounts.invalidate()
     self.managed_users_store.remove(user.username)
 
   def finalize(self, model: ConfigModel, dryrun: bool):
@@ -2,7 +2,8 @@ from __future__ import annotations
 
 from typing import Generator, Sequence
 
-from koti.utils.shell import shell, shell_output
+from koti.utils.accounts import AccountDatabase, account_database
+from koti.utils.shell import run
 from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, SystemState
 from koti.items.user_group import UserGroupAssignment
 from koti.managers.user import UserManager
@@ -19,61 +20,90 @@ class UserGroupManager(ConfigManager[UserGroupAssignment, UserGroupAssignmentSta
   cleanup_order: float = UserManager.cleanup_order  # these should usually stick together
   managed_users_store: JsonCollection[str]
   cleanup_order_before = [UserManager]
+  accounts: AccountDatabase
 
   def __init__(self):
     super().__init__()
     store = JsonStore("/var/cache/koti/UserGroupManager.json")
     self.managed_users_store = store.collection("managed_users")
+    self.accounts = account_database
 
   def assert_installable(self, item: UserGroupAssignment, model: ConfigModel):
     pass
 
   def get_state(self, item: UserGroupAssignment, system_state: SystemState) -> UserGroupAssignmentState | None:
-    for line in shell_output("getent group | cut -d: -f1,4").splitlines():
-      [group, users_csv] = line.split(":")
-      if group == item.group and item.username in users_csv.split(","):
-        return UserGroupAssignmentState()
-    return None
+    group = self.accounts.groups().get(item.group, None)
+    return UserGroupAssignmentState() if group is not None and item.username in group.members else None
+
+  def get_states(self, items: Sequence[UserGroupAssignment], system_state: SystemState) -> dict[UserGroupAssignment, UserGroupAssignmentState | None]:
+    groups = self.accounts.groups()
+    return {item: UserGroupAssignmentState() if item.group in groups and item.username in groups[item.group].members else None for item in items}
 
   def get_install_actions(self, items_to_check: Sequence[UserGroupAssignment], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
+    items_to_assign: list[UserGroupAssignment] = []
     for item in items_to_check:
       current = system_state.get_state(item, system_state, UserGroupAssignmentState)
       target = UserGroupAssignmentState()
       if current == target:
         continue
+      items_to_assign.append(item)
+    if items_to_assign:
       yield Action(
-        installs = {item: target},
-        description = f"assign user {item.username} to group {item.group}",
-        execute = lambda: self.assign_group(item),
+        installs = {item: UserGroupAssignmentState() for item in items_to_assign},
+        description = f"assign user(s) to group(s): {", ".join(f"{item.username} => {item.group}" for item in items_to_assign)}",
+        execute = lambda: self.assign_groups(items_to_assign),
       )
 
   def get_cleanup_actions(self, items_to_keep: Sequence[UserGroupAssignment], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    for item in self.get_managed_items(model):
-      if item in items_to_keep:
-        continue
+    items_to_unassign = [item for item in self.get_managed_items(model) if item not in items_to_keep]
+    if items_to_unassign:
       yield Action(
-        removes = [item],
-        description = f"unassign {item.username} from group {item.group}",
-        execute = lambda: self.unassign_group(item),
+        removes = items_to_unassign,
+        description = f"unassign user(s) from group(s): {", ".join(f"{item.username} => {item.group}" for item in items_to_unassign)}",
+        execute = lambda: self.unassign_groups(items_to_unassign),
       )
 
   def get_managed_items(self, model: ConfigModel) -> list[UserGroupAssignment]:
     result: list[UserGroupAssignment] = []
     currently_managed_users = set([item.username for group in model.configs for item in group.provides if isinstance(item, UserGroupAssignment)])
     previously_managed_users = self.managed_users_store.elements()
+    groups = self.accounts.groups()
     for username in {*previously_managed_users, *currently_managed_users}:
-      for line in shell_output("getent group | cut -d: -f1,4").splitlines():
-        [group, users_csv] = line.split(":")
-        if username in users_csv.split(","):
-          result.append(UserGroupAssignment(username, group))
+      for group in groups.values():
+        if username in group.members:
+          result.append(UserGroupAssignment(username, group.name))
     return result
 
+  def assign_groups(self, items: list[UserGroupAssignment]):
+    transaction = self.accounts.transaction()
+    for item in items:
+      transaction.add_to_group(item.username, item.group)
+    if not transaction.commit():
+      for item in items:
+        self.assign_group(item)
+    self.managed_users_store.add_all([item.username for item in items])
+
+  def unassign_groups(self, items: list[UserGroupAssignment]):
+    transaction = self.accounts.transaction()
+    for item in items:
+      transaction.remove_from_group(item.username, item.group)
+    if not transaction.commit():
+      for item in items:
+        self.unassign_group(item)
+    # do not delete users from list of managed users here, as there might be other assignments for them
+
   def assign_group(self, item: UserGroupAssignment):
-    shell(f"gpasswd --add {item.username} {item.group}")
+    try:
+      run(["gpasswd", "--add", item.username, item.group])
+    finally:
+      self.accounts.invalidate()
     self.managed_users_store.add(item.username)
 
   def unassign_group(self, item: UserGroupAssignment):
-    shell(f"gpasswd --delete {item.username} {item.group}")
+    try:
+      run(["gpasswd", "--delete", item.username, item.group])
+    finally:
+      self.accounts.invalidate()
     # do not delete user from list of managed users here, as there might be other assignments for this user
 
   def finalize(self, model: ConfigModel, dryrun: bool):
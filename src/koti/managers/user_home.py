@@ -1,13 +1,13 @@
 from __future__ import annotations
 
 import os
-import pwd
 from hashlib import sha256
 from typing import Generator, Sequence
 
 from koti.utils.logging import logger
-from koti.utils.shell import shell, shell_output
-from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, DryRunSystemState, SystemState
+from koti.utils.accounts import AccountDatabase, account_database
+from koti.utils.shell import run
+from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, DryRunSystemState, ManagedConfigItem, SystemState
 from koti.items.user_home import UserHome
 from koti.managers.user import UserManager
 from koti.utils.json_store import JsonCollection, JsonStore
@@ -30,11 +30,13 @@ class UserHomeManager(ConfigManager[UserHome, UserHomeState]):
   cleanup_order: float = UserManager.cleanup_order  # these should usually stick together
   managed_users_store: JsonCollection[str]
   cleanup_order_before = [UserManager]
+  accounts: AccountDatabase
 
   def __init__(self):
     super().__init__()
     store = JsonStore("/var/cache/koti/UserHomeManager.json")
     self.managed_users_store = store.collection("managed_users")
+    self.accounts = account_database
 
   def assert_installable(self, item: UserHome, model: ConfigModel):
     assert item.homedir is not None, f"{item}: no homedir specified"
@@ -46,7 +48,17 @@ class UserHomeManager(ConfigManager[UserHome, UserHomeState]):
     user_home = user_homes[item.username]
     return UserHomeState(home_dir = user_home, home_exists = os.path.isdir(user_home))
 
+  def get_states(self, items: Sequence[UserHome], system_state: SystemState) -> dict[UserHome, UserHomeState | None]:
+    user_homes: dict[str, str] = self.get_all_user_homes()
+    return {
+      item: UserHomeState(home_dir = user_homes[item.username], home_exists = os.path.isdir(user_homes[item.username])) if item.username in user_homes else None
+      for item in items
+    }
+
   def get_install_actions(self, items_to_check: Sequence[UserHome], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
+    targets: dict[UserHome, UserHomeState] = {}
+    homes_to_create: list[tuple[str, str]] = []
+    homes_to_change: list[tuple[str, str]] = []
     for item in items_to_check:
       assert item.homedir is not None
       current = system_state.get_state(item, system_state, UserHomeState)
@@ -55,52 +67,66 @@ class UserHomeManager(ConfigManager[UserHome, UserHomeState]):
         continue
 
       if (current is None or not current.home_exists) and target.home_exists:
-        yield Action(
-          updates = {item: target},
-          description = f"create homedir {target.home_dir} for user {item.username}",
-          execute = lambda: self.create_user_home(item.username, target.home_dir),
-        )
+        homes_to_create.append((item.username, target.home_dir))
+        targets[item] = target
       elif current is not None and current.home_exists and not target.home_exists:
         logger.info("to prevent accidental data loss, koti will not remove user home directories")
+      elif current is not None and current.home_dir != target.home_dir:
+        homes_to_change.append((item.username, target.home_dir))
+        targets[item] = target
 
-      if current is not None and current.home_dir != target.home_dir:
-        yield Action(
-          updates = {item: target},
-          description = f"change homedir to {target.home_dir} for user {item.username}",
-          execute = lambda: self.update_user_home(item.username, target.home_dir),
-        )
+    if targets:
+      updates: dict[ManagedConfigItem, ConfigItemState] = {item: target for item, target in targets.items()}
+      yield Action(
+        updates = updates,
+        description = f"create/change homedir(s) for user(s) {", ".join(item.username for item in targets)}",
+        additional_info = [
+          *(f"create homedir {homedir} for user {username}" for username, homedir in homes_to_create),
+          *(f"change homedir to {homedir} for user {username}" for username, homedir in homes_to_change),
+        ],
+        execute = lambda: self.apply_user_homes(homes_to_create, homes_to_change),
+      )
 
   def get_cleanup_actions(self, items_to_keep: Sequence[UserHome], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    for item in self.get_managed_items(model):
-      if item in items_to_keep:
-        continue
+    items_to_clear = [item for item in self.get_managed_items(model) if item not in items_to_keep]
+    if items_to_clear:
       yield Action(
-        removes = [item],
-        description = f"clear homedir from /etc/passwd for user {item.username}",
-        execute = lambda: self.remove_user_home(item.username, isinstance(system_state, DryRunSystemState)),
+        removes = items_to_clear,
+        description = f"clear homedir from /etc/passwd for user(s) {", ".join(item.username for item in items_to_clear)}",
+        execute = lambda: self.remove_user_homes([item.username for item in items_to_clear], isinstance(system_state, DryRunSystemState)),
       )
 
   def get_all_user_homes(self) -> dict[str, str]:
-    return dict([line.split(":") for line in shell_output("getent passwd | cut -d: -f1,6").splitlines()])
-
-  def create_user_home(self, username: str, homedir: str):
-    pwnam = pwd.getpwnam(username)
-    uid = pwnam.pw_uid
-    gid = pwnam.pw_gid
-    os.mkdir(homedir)
-    os.chown(homedir, uid, gid)
-    shell(f"usermod --home {homedir} {username}")
-    self.managed_users_store.add(username)
-
-  def update_user_home(self, username: str, new_home: str):
-    shell(f"usermod --home {new_home} {username}")
-    self.managed_users_store.add(username)
-
-  def remove_user_home(self, username: str, dryrun: bool):
-    shell(f"usermod --home /nonexistent {username}")
-    self.managed_users_store.remove(username)
+    return {username: entry.home for username, entry in self.accounts.users().items()}
+
+  def apply_user_homes(self, homes_to_create: list[tuple[str, str]], homes_to_change: list[tuple[str, str]]):
+    for username, homedir in homes_to_create:
+      pwnam = self.accounts.user(username)
+      os.mkdir(homedir)
+      os.chown(homedir, pwnam.uid, pwnam.gid)
+    self.set_user_homes([*homes_to_create, *homes_to_change])
+    self.managed_users_store.add_all([username for username, homedir in [*homes_to_create, *homes_to_change]])
+
+  def remove_user_homes(self, usernames: list[str], dryrun: bool):
+    self.set_user_homes([(username, "/nonexistent") for username in usernames])
+    self.managed_users_store.remove_all(usernames)
     if not dryrun:
-      logger.warn(f"the homedir of user {username} has not been deleted to prevent accidental data loss - please do it manually")
+      for username in usernames:
+        logger.warn(f"the homedir of user {username} has not been deleted to prevent accidental data loss - please do it manually")
+
+  def set_user_homes(self, homes: list[tuple[str, str]]):
+    transaction = self.accounts.transaction()
+    for username, homedir in homes:
+      transaction.set_home(username, homedir)
+    if not transaction.commit():
+      for username, homedir in homes:
+        self.usermod_home(username, homedir)
+
+  def usermod_home(self, username: str, homedir: str):
+    try:
+      run(["usermod", "--home", homedir, username])
+    finally:
+      self.accounts.invalidate()
 
   def get_managed_items(self, model: ConfigModel) -> list[UserHome]:
     result: list[UserHome] = []
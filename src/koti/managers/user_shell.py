@@ -3,8 +3,9 @@ from __future__ import annotations
 from hashlib import sha256
 from typing import Generator, Sequence
 
-from koti.utils.shell import shell, shell_output
-from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, SystemState
+from koti.utils.accounts import AccountDatabase, account_database
+from koti.utils.shell import run
+from koti.model import Action, ConfigItemState, ConfigManager, ConfigModel, ManagedConfigItem, SystemState
 from koti.items.user_shell import UserShell
 from koti.utils.json_store import JsonCollection, JsonStore
 from koti.managers.user import UserManager
@@ -25,11 +26,13 @@ class UserShellManager(ConfigManager[UserShell, UserShellState]):
   cleanup_order: float = UserManager.cleanup_order  # these should usually stick together
   managed_users_store: JsonCollection[str]
   cleanup_order_before = [UserManager]
+  accounts: AccountDatabase
 
   def __init__(self):
     super().__init__()
     store = JsonStore("/var/cache/koti/UserShellManager.json")
     self.managed_users_store = store.collection("managed_users")
+    self.accounts = account_database
 
   def assert_installable(self, item: UserShell, model: ConfigModel):
     assert item.shell is not None, f"{item}: no shell specified"
@@ -40,34 +43,54 @@ class UserShellManager(ConfigManager[UserShell, UserShellState]):
       return None  # user not in /etc/passwd
     return UserShellState(shell = user_shells[item.username])
 
+  def get_states(self, items: Sequence[UserShell], system_state: SystemState) -> dict[UserShell, UserShellState | None]:
+    user_shells: dict[str, str] = self.get_all_user_shells()
+    return {item: UserShellState(shell = user_shells[item.username]) if item.username in user_shells else None for item in items}
+
   def get_install_actions(self, items_to_check: Sequence[UserShell], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
+    targets: dict[UserShell, UserShellState] = {}
     for item in items_to_check:
       assert item.shell is not None
       current = system_state.get_state(item, system_state, UserShellState)
       target = UserShellState(shell = item.shell)
       if current == target:
         continue
+      targets[item] = target
+    if targets:
+      updates: dict[ManagedConfigItem, ConfigItemState] = {item: target for item, target in targets.items()}
       yield Action(
-        updates = {item: target},
-        description = f"update shell for user {item.username} to {target.shell}",
-        execute = lambda: self.update_user_shell(item, target.shell),
+        updates = updates,
+        description = f"update shell for user(s) {", ".join(item.username for item in targets)}",
+        additional_info = [f"{item.username}: {target.shell}" for item, target in targets.items()],
+        execute = lambda: self.update_user_shells([(item, target.shell) for item, target in targets.items()]),
       )
 
   def get_cleanup_actions(self, items_to_keep: Sequence[UserShell], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
-    for item in self.get_managed_items(model):
-      if item in items_to_keep:
-        continue
+    items_to_reset = [item for item in self.get_managed_items(model) if item not in items_to_keep]
+    if items_to_reset:
       yield Action(
-        removes = [item],
-        description = f"reset shell for user {item.username} to /usr/bin/nologin",
-        execute = lambda: self.update_user_shell(item, "/usr/bin/nologin"),
+        removes = items_to_reset,
+        description = f"reset shell for user(s) {", ".join(item.username for item in items_to_reset)} to /usr/bin/nologin",
+        execute = lambda: self.update_user_shells([(item, "/usr/bin/nologin") for item in items_to_reset]),
       )
 
   def get_all_user_shells(self) -> dict[str, str]:
-    return dict([line.split(":") for line in shell_output("getent passwd | cut -d: -f1,7").splitlines()])
+    return {username: entry.shell for username, entry in self.accounts.users().items()}
+
+  def update_user_shells(self, changes: list[tuple[UserShell, str]]):
+    transaction = self.accounts.transaction()
+    for user, new_shell in changes:
+      transaction.set_shell(user.username, new_shell)
+    if not transaction.commit():
+      for user, new_shell in changes:
+        self.update_user_shell(user, new_shell)
+    self.managed_users_store.add_all([user.username for user, new_shell in changes])
 
   def update_user_shell(self, user: UserShell, new_shell: str | None):
-    shell(f"usermod --shell {new_shell or "/usr/bin/nologin"} {user.username}")
+    try:
+      run(["usermod", "--shell", new_shell or "/usr/bin/nologin", user.username])
+    finally:
+      self.accounts.invalidate()
     self.managed_users_store.add(user.username)
 
   def get_managed_items(self, model: ConfigModel) -> list[UserShell]:
@@ -144,34 +144,113 @@ class SystemState(metaclass = ABCMeta):
     pass
 
 
-class DryRunSystemState(SystemState):
-  actual: ActualSystemState
+class CachingSystemState(SystemState):
+  """Memoizes the states returned by another SystemState, so items that get inspected multiple times (e.g. by their
+  own manager and again as PostHook trigger) only have to be probed once. Whenever an item changes, its entry has
+  to be invalidated. As states may be composed of other states (such as Directory, which consists of Files), the
+  cache also tracks which states have been read while calculating another one, and invalidates them together."""
+  inner: SystemState
+  states: dict[ManagedConfigItem, ConfigItemState | None]
+  components: dict[ManagedConfigItem, set[ManagedConfigItem]]  # states that were read while calculating a state
+  composites: dict[ManagedConfigItem, set[ManagedConfigItem]]  # reverse lookup of components
+  calculating: list[ManagedConfigItem]
+  hits: int
+  misses: int
+
+  def __init__(self, inner: SystemState):
+    self.inner = inner
+    self.states = {}
+    self.components = {}
+    self.composites = {}
+    self.calculating = []
+    self.hits = 0
+    self.misses = 0
+
+  def get_state_untyped(self, reference: ManagedConfigItem, system_state: SystemState) -> ConfigItemState | None:
+    self.record_access(reference)
+    if reference in self.states:
+      self.hits += 1
+      return self.states[reference]
+    self.misses += 1
+    self.calculating.append(reference)
+    try:
+      state = self.inner.get_state_untyped(reference, system_state)
+    finally:
+      self.calculating.pop()
+    self.states[reference] = state
+    return state
+
+  def prefetch(self, manager: ConfigManager, items: Sequence[ManagedConfigItem], system_state: SystemState):
+    """Loads the states of all given items that aren't cached yet via a single call of manager.get_states()."""
+    missing = [item for item in dict.fromkeys(items) if item not in self.states]
+    if not missing:
+      return
+    if not manager.has_batched_get_states():
+      for item in missing:
+        self.get_state_untyped(item, system_state)  # one by one, so composed states get tracked
+    else:
+      self.put_prefetched(manager.get_states(missing, system_state))
+
+  def put_prefetched(self, states: dict[ManagedConfigItem, ConfigItemState | None]):
+    """Stores states that have been probed outside of the cache (each of them counts as a miss)."""
+    self.misses += len(states)
+    self.states.update(states)
+
+  def record_access(self, reference: ManagedConfigItem):
+    if self.calculating and self.calculating[-1] != reference:
+      self.components.setdefault(self.calculating[-1], set()).add(reference)
+      self.composites.setdefault(reference, set()).add(self.calculating[-1])
+
+  def invalidate(self, references: Iterable[ManagedConfigItem]):
+    """Drops the cached states of the given items, including the states they are composed of or are part of."""
+    pending = list(references)
+    while pending:
+      reference = pending.pop()
+      self.states.pop(reference, None)
+      for related in [*self.components.pop(reference, ()), *self.composites.pop(reference, ())]:
+        self.components.get(related, set()).discard(reference)
+        self.composites.get(related, set()).discard(reference)
+        pending.append(related)
+
+  def clear(self):
+    self.states.clear()
+    self.components.clear()
+    self.composites.clear()
+
+  def statistics(self) -> str:
+    lookups = self.hits + self.misses
+    return f"state cache: {self.hits} of {lookups} state lookups were answered from the cache ({self.misses} states probed)"
+
+
+class DryRunSystemState(CachingSystemState):
   temp_states: dict[ManagedConfigItem, ConfigItemState | None]
 
   def __init__(self, managers: Sequence[ConfigManager]):
-    self.actual = ActualSystemState(managers)
+    super().__init__(ActualSystemState(managers))
     self.temp_states = {}
 
   def get_state_untyped(self, reference: ManagedConfigItem, system_state: SystemState) -> ConfigItemState | None:
     if reference in self.temp_states.keys():
+      self.record_access(reference)
       return self.temp_states[reference]
-    return self.actual.get_state_untyped(reference, system_state)
+    return super().get_state_untyped(reference, system_state)
+
+  def prefetch(self, manager: ConfigManager, items: Sequence[ManagedConfigItem], system_state: SystemState):
+    super().prefetch(manager, [item for item in items if item not in self.temp_states], system_state)
 
   def put_state(self, reference: ManagedConfigItem, state: ConfigItemState | None):
     self.temp_states[reference] = state
+    self.invalidate([reference])
 
 
 class ActualSystemState(SystemState):
-  managers: Sequence[ConfigManager]
+  managers: ManagerRegistry
 
   def __init__(self, managers: Sequence[ConfigManager]):
-    self.managers = managers
+    self.managers = ManagerRegistry.of(managers)
 
   def get_state_untyped(self, reference: ManagedConfigItem, system_state: SystemState) -> ConfigItemState | None:
-    for manager in self.managers:
-      if reference.__class__ in manager.managed_classes:
-        return manager.get_state(reference, system_state)
-    raise AssertionError(f"manager not found for {reference}")
+    return self.managers.manager_for(reference).get_state(reference, system_state)
 
 
 class ConfigManager[T: ManagedConfigItem, S: ConfigItemState](metaclass = ABCMeta):
@@ -179,6 +258,7 @@ class ConfigManager[T: ManagedConfigItem, S: ConfigItemState](metaclass = ABCMet
   cleanup_order: float = 0.0
   cleanup_order_before: Sequence[type[ConfigManager]] = []  # Restrictions to override the numeric ordering
   cleanup_order_after: Sequence[type[ConfigManager]] = []  # Restrictions to override the numeric ordering
+  invocation_cost: float = 1.0  # relative cost of one install step of this manager; expensive managers get fewer steps
 
   @abstractmethod
   def assert_installable(self, item: T, model: ConfigModel):
@@ -192,6 +272,14 @@ class ConfigManager[T: ManagedConfigItem, S: ConfigItemState](metaclass = ABCMet
     SystemState, to support items such as Directory, which are composed of other items (Files)."""
     pass
 
+  def get_states(self, items: Sequence[T], system_state: SystemState) -> dict[T, S | None]:
+    """Returns the states of multiple items at once. Called once per install/cleanup step, so managers can
+    override this to query the system once for all items (the default implementation calls get_state per item)."""
+    return {item: self.get_state(item, system_state) for item in items}
+
+  def has_batched_get_states(self) -> bool:
+    return type(self).get_states is not ConfigManager.get_states
+
   @abstractmethod
   def get_install_actions(self, items_to_check: Sequence[T], model: ConfigModel, system_state: SystemState) -> Generator[Action]:
     """Called during install phases. This method checks a set of items if any actions need to be
@@ -214,6 +302,54 @@ class ConfigManager[T: ManagedConfigItem, S: ConfigItemState](metaclass = ABCMet
     pass
 
 
+class ManagerRegistry(Sequence[ConfigManager]):
+  """The list of managers, plus a lookup table from item classes to the managers responsible for them. Subclasses
+  of managed classes are resolved via their MRO (the most specific registered class wins). Resolved classes are
+  cached, so looking up a manager is a single dict access."""
+  managers: list[ConfigManager]
+  registered: dict[type, list[ConfigManager]]
+  resolved: dict[type, list[ConfigManager]]
+
+  def __init__(self, managers: Iterable[ConfigManager]):
+    self.managers = list(managers)
+    self.registered = {}
+    self.resolved = {}
+    for manager in self.managers:
+      for managed_class in manager.managed_classes:
+        self.registered.setdefault(managed_class, []).append(manager)
+
+  @classmethod
+  def of(cls, managers: Iterable[ConfigManager]) -> ManagerRegistry:
+    return managers if isinstance(managers, ManagerRegistry) else ManagerRegistry(managers)
+
+  def managers_for(self, item_class: type) -> list[ConfigManager]:
+    result = self.resolved.get(item_class, None)
+    if result is None:
+      result = next((self.registered[base] for base in item_class.__mro__ if base in self.registered), [])
+      self.resolved[item_class] = result
+    return result
+
+  def manager_for[T: ManagedConfigItem](self, item: T) -> ConfigManager[T, ConfigItemState]:
+    managers = self.managers_for(item.__class__)
+    if not managers:
+      raise AssertionError(f"manager not found for {item}")
+    return managers[0]
+
+  @overload
+  def __getitem__(self, index: int) -> ConfigManager:
+    pass
+
+  @overload
+  def __getitem__(self, index: slice) -> Sequence[ConfigManager]:
+    pass
+
+  def __getitem__(self, index: int | slice) -> ConfigManager | Sequence[ConfigManager]:
+    return self.managers[index]
+
+  def __len__(self) -> int:
+    return len(self.managers)
+
+
 class Action:
   """Represents an executable action to update one or multiple ManagedConfigItems on the system."""
   installs: dict[ManagedConfigItem, ConfigItemState]
@@ -267,7 +403,7 @@ class ConfigModel:
   provides a set of convenience functions to access ConfigItems (useful for dynamic configuration items
   such as files that have their content written by inspecting other items)."""
   configs: Sequence[MergedConfig]
-  managers: Sequence[ConfigManager]
+  managers: ManagerRegistry
   steps: Sequence[InstallStep]
 
   def __init__(
@@ -277,7 +413,7 @@ class ConfigModel:
     steps: Sequence[InstallStep],
   ):
     self.configs = configs
-    self.managers = managers
+    self.managers = ManagerRegistry.of(managers)
     self.steps = steps
 
   @overload
@@ -315,10 +451,7 @@ class ConfigModel:
     return False
 
   def manager[T: ManagedConfigItem](self, reference: T) -> ConfigManager[T, ConfigItemState]:
-    for manager in self.managers:
-      if reference.__class__ in manager.managed_classes:
-        return manager
-    raise AssertionError(f"manager not found for {reference}")
+    return self.managers.manager_for(reference)
 
 
 class InstallStep:
@@ -1,13 +1,25 @@
 from __future__ import annotations
 
+import json
+import os
 import sys
+import time
 from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from hashlib import sha256
 from math import ceil
+from typing import Unpack
 
-from pyscipopt import Constraint as Cons, Expr, Model, Model, SCIP_PARAMEMPHASIS, Variable  # type: ignore
+from pyscipopt import Constraint as Cons, Expr, Model, SCIP_PARAMEMPHASIS, Variable, quicksum  # type: ignore
 
+from koti.graph import InstallGraph, merge_manager_sequences
+from koti.items.checkpoint import Checkpoint
 from koti.model import *
+from koti.selectors import ItemIndex, Selector
 from koti.utils.json_store import *
+from koti.utils.logging import logger
+
+type InstallOrderStrategy = Literal["graph", "solver"]
 
 
 class InfeasibleError(AssertionError):
@@ -26,44 +38,262 @@ class ExtraConstraints:
     self.different_value_pairs = different_value_pairs or []
 
 
+def create_solver_model(graph: InstallGraph, is_iis_search: bool) -> tuple[Model, Variable, list[Variable]]:
+  """Sets up a solver model with one position variable per node of the graph."""
+  model = Model("koti")
+  objective = model.addVar("objective", vtype = "I")
+
+  # create a variable for each item
+  pos_vars: list[Variable] = [model.addVar(vtype = "I") for node in range(graph.size)]
+
+  # only the last item in each group can influence the objective function
+  for group in graph.groups:
+    model.addCons(objective >= pos_vars[group[-1]])
+
+  # apply ordering constraints (within groups as well as the ones defined by the items themselves)
+  for (node1, node2), weight in graph.edges.items():
+    model.addCons(pos_vars[node2] - pos_vars[node1] >= weight)
+
+  model.hideOutput(True)
+  model.setMinimize()
+  model.setObjective(objective)
+  if is_iis_search:
+    model.setEmphasis(SCIP_PARAMEMPHASIS.FEASIBILITY)
+  return model, objective, pos_vars
+
+
+def apply_solver_limits(model: Model, time_limit: float | None, gap_limit: float | None):
+  """Lets the solver stop early; afterwards, the best solution found so far (if any) can still be retrieved."""
+  if time_limit is not None:
+    model.setParam("limits/time", max(time_limit, 0.0))
+  if gap_limit is not None:
+    model.setParam("limits/gap", gap_limit)
+
+
+def stopped_at_limit(model: Model, subject: str) -> bool:
+  """Checks if the solver stopped because of a time/gap limit and reports how far the result may be from the optimum."""
+  status = model.getStatus()
+  if status not in ("timelimit", "gaplimit"):
+    return False
+  if model.getNSols() > 0:
+    logger.info(f"{subject}: solver stopped at its {status.removesuffix("limit")} limit, the result is within {model.getGap():.1%} of the optimum")
+  return True
+
+
+def is_feasible_graph(graph: InstallGraph) -> bool:
+  """Solver-based feasibility check. Only depends on the graph, so it can be run in a worker process."""
+  model, objective, pos_vars = create_solver_model(graph.transitive_reduction(), is_iis_search = True)
+  model.optimize()
+  return model.getStatus() != "infeasible"
+
+
+class InvocationCostModel:
+  """Solver model that minimizes the total invocation cost of an install order (the same metric as
+  InstallGraph.cost()): a binary indicator for each step and manager has to be set if any node of that manager is
+  installed in the step, and the objective is the sum of all indicators weighted by the invocation_cost of their
+  manager. Each step may only be used by a single manager, and used steps come first.
+  Positions are expressed via binaries that state whether a node is installed at a step or any later one, which
+  keeps the LP relaxation of the ordering constraints tight. The number of steps is limited to max_steps, and for
+  acyclic graphs each node is further restricted to the steps that leave room for its longest incoming and
+  outgoing paths. Even so, the model is a lot larger than the one of create_solver_model(), so it is meant to
+  improve a known install order, which is passed as primal start."""
+  graph: InstallGraph
+  model: Model
+  pos_vars: list[Variable]
+  used_vars: list[dict[int, Variable]]  # step -> manager -> indicator
+  started_vars: list[dict[int, Variable]]  # node -> step -> installed at the step or later
+  heads: list[int]
+
+  def __init__(self, graph: InstallGraph, manager_costs: Sequence[float], max_steps: int):
+    self.graph = graph
+    self.model = Model("koti")
+    order = graph.topological_order()
+    self.heads = graph.head_lengths(order) if order is not None else [0] * graph.size
+    tails = graph.tail_lengths(order) if order is not None else [0] * graph.size
+    managers = sorted(set(graph.managers))
+
+    self.used_vars = [{manager: self.model.addVar(vtype = "B") for manager in managers} for step in range(max_steps)]
+    for step in range(max_steps):
+      self.model.addCons(quicksum(self.used_vars[step].values()) <= 1)
+      if step > 0:
+        self.model.addCons(quicksum(self.used_vars[step].values()) <= quicksum(self.used_vars[step - 1].values()))
+
+    # lower bounds for the number of steps per manager and in total, which usually prove optimality right away
+    manager_steps = graph.manager_step_lower_bounds(order) if order is not None else {manager: 1 for manager in managers}
+    for manager in managers:
+      self.model.addCons(quicksum(self.used_vars[step][manager] for step in range(max_steps)) >= manager_steps[manager])
+    for step in range(max((head + tail for head, tail in zip(self.heads, tails)), default = -1) + 1):
+      self.model.addCons(quicksum(self.used_vars[step].values()) >= 1)
+
+    self.pos_vars = [self.model.addVar(vtype = "I") for node in range(graph.size)]
+    self.started_vars = []
+    for node, pos_var in enumerate(self.pos_vars):
+      self.started_vars.append({step: self.model.addVar(vtype = "B") for step in range(self.heads[node] + 1, max_steps - tails[node])})
+      self.model.addCons(pos_var == self.heads[node] + quicksum(self.started_vars[node].values()))
+      for step in range(self.heads[node] + 2, max_steps - tails[node]):
+        self.model.addCons(self.started_vars[node][step] <= self.started_vars[node][step - 1])
+      for step in range(self.heads[node], max_steps - tails[node]):
+        self.model.addCons(self.started(node, step) - self.started(node, step + 1) <= self.used_vars[step][graph.managers[node]])
+
+    for (node1, node2), weight in graph.edges.items():
+      self.model.addCons(self.pos_vars[node2] - self.pos_vars[node1] >= weight)
+      for step, started_var in self.started_vars[node1].items():
+        if step + weight > self.heads[node2]:
+          self.model.addCons(started_var <= self.started(node2, step + weight))
+
+    self.model.hideOutput(True)
+    self.model.setMinimize()
+    self.model.setObjective(quicksum(
+      manager_costs[manager] * used_var for used_vars_for_step in self.used_vars for manager, used_var in used_vars_for_step.items()
+    ))
+    self.model.setEmphasis(SCIP_PARAMEMPHASIS.EASYCIP)  # the lower bounds are usually tight, presolving doesn't pay off
+
+  def started(self, node: int, step: int) -> Variable | int:
+    return 1 if step <= self.heads[node] else self.started_vars[node].get(step, 0)
+
+  def add_primal_start(self, positions: Sequence[int]):
+    """Hands a valid install order to the solver as starting point. The positions have to be numbered
+    consecutively and must not exceed max_steps."""
+    sol = self.model.createSol()
+    for node, pos_var in enumerate(self.pos_vars):
+      self.model.setSolVal(sol, pos_var, positions[node])
+      for step, started_var in self.started_vars[node].items():
+        self.model.setSolVal(sol, started_var, 1 if positions[node] >= step else 0)
+    used = {(position, self.graph.managers[node]) for node, position in enumerate(positions)}
+    for step, used_vars_for_step in enumerate(self.used_vars):
+      for manager, used_var in used_vars_for_step.items():
+        self.model.setSolVal(sol, used_var, 1 if (step, manager) in used else 0)
+    self.model.addSol(sol)
+
+
+class InstallPhaseOptimizerArgs(TypedDict, total = False):
+  """Tuning options for InstallPhaseOptimizer (can also be passed to Koti)."""
+  time_limit: float | None  # seconds
+  gap_limit: float | None  # relative gap, e.g. 0.05
+  strategy: InstallOrderStrategy
+  plan_cache: InstallPlanCache | None
+  incremental: bool
+  iis_workers: int
+  checkpoint_barriers: bool
+
+
+class InstallPlanCache:
+  """Persists calculated install orders between runs. Entries are keyed by a fingerprint of the config structure
+  (see InstallPhaseOptimizer.fingerprint) and store the step index of each item. When the cache exceeds its
+  maximum size, the least recently used entries get evicted."""
+  store: JsonStore
+  plans: JsonMapping[str, dict[str, Any]]
+  max_entries: int
+
+  def __init__(self, store_file: str = "/var/cache/koti/InstallPlanCache.json", max_entries: int = 16):
+    self.store = JsonStore(store_file)
+    self.plans = self.store.mapping("plans")
+    self.max_entries = max_entries
+
+  def get(self, fingerprint: str, graph: InstallGraph) -> list[int] | None:
+    entry = self.plans.get(fingerprint, None)
+    if entry is None or not isinstance(entry.get("positions", None), list):
+      return None
+    positions: list[int] = entry["positions"]
+    if not all(isinstance(position, int) for position in positions) or not graph.is_valid_layering(positions):
+      self.plans.remove(fingerprint)
+      return None
+    self.plans.put(fingerprint, {**entry, "last_used": time.time()})
+    return positions
+
+  def put(self, fingerprint: str, positions: Sequence[int]):
+    self.plans.put(fingerprint, {"positions": list(positions), "last_used": time.time()})
+    fingerprints_by_age = sorted(self.plans.keys(), key = lambda key: self.plans.get(key, {}).get("last_used", 0), reverse = True)
+    for outdated in fingerprints_by_age[self.max_entries:]:
+      self.plans.remove(outdated)
+
+
 class InstallPhaseOptimizer:
-  """Runs an algorithm to calculate a (near) optimal installation order that minimizes ConfigManager invocations."""
-  managers: Sequence[ConfigManager]
+  """Runs an algorithm to calculate a (near) optimal installation order that minimizes ConfigManager invocations,
+  weighted by the invocation_cost of each manager. Two strategies are available:
+  - "graph" (default) layers the dependency graph greedily and only falls back to the solver if the
+    result cannot be proven optimal (i.e. it is more expensive than the lower bound of the graph).
+  - "solver" always uses the integer programming approach. The solver first minimizes the number of steps, then
+    the cheaper one of its result and the greedy layering is improved with respect to the invocation costs.
+  Results are persisted in an InstallPlanCache (if given), so unchanged configs skip the calculation entirely."""
+  managers: ManagerRegistry
   configs: Sequence[Sequence[ManagedConfigItem]]
-
-  def __init__(self, configs: Sequence[Sequence[ManagedConfigItem]], managers: Sequence[ConfigManager]):
-    self.managers = managers
+  strategy: InstallOrderStrategy
+  plan_cache: InstallPlanCache | None
+  incremental: bool
+  iis_workers: int
+  checkpoint_barriers: bool
+  time_limit: float | None
+  gap_limit: float | None
+  deadline: float | None
+  limits_reached: bool
+  manager_costs: list[float]
+  item_index: ItemIndex
+  resolved_selectors: dict[Callable[[ManagedConfigItem], bool], list[ManagedConfigItem]]
+  known_feasibility: dict[frozenset[ManagedConfigItem], bool]
+
+  def __init__(
+    self,
+    configs: Sequence[Sequence[ManagedConfigItem]],
+    managers: Sequence[ConfigManager],
+    **kwargs: Unpack[InstallPhaseOptimizerArgs],
+  ):
+    self.managers = ManagerRegistry.of(managers)
     self.configs = configs
+    self.strategy = kwargs.get("strategy", "graph")
+    self.plan_cache = kwargs.get("plan_cache", None)
+    self.incremental = kwargs.get("incremental", False)
+    self.iis_workers = kwargs.get("iis_workers", os.cpu_count() or 1)
+    self.checkpoint_barriers = kwargs.get("checkpoint_barriers", False)
+    self.time_limit = kwargs.get("time_limit", None)
+    self.gap_limit = kwargs.get("gap_limit", None)
+    self.deadline = None
+    self.limits_reached = False
+    self.manager_costs = [manager.invocation_cost for manager in managers]
+    self.item_index = ItemIndex(item for config in configs for item in config)
+    self.resolved_selectors = {}
+    self.known_feasibility = {}
 
   def calc_install_steps(self) -> Sequence[InstallStep]:
-    """Runs the solver repeatedly an a partially specified problem, adding additional constraints
-    to avoid undesired results whenever necessary.
-    (This is a lot faster than specifying the full-scale problem, because the number of constraints grows
-    quadratically and involves integer variables. We sacrifice a bit of optimality, but in practice, this
-    seems to be barely ever noticeable.)"""
     sys.stdout.write("merging configs...")
     sys.stdout.flush()
 
     try:
-      solution: dict[ManagedConfigItem, int] = {}
-      constraints: ExtraConstraints | None = ExtraConstraints()
-      while constraints is not None:
-        solution = self.solve(
-          configs = self.configs,
-          extra_constraints = constraints,
-          is_iis_search = False
-        )
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        constraints = self.adjust_constraints(solution, constraints)
+      self.deadline = time.monotonic() + self.time_limit if self.time_limit is not None else None
+      self.limits_reached = False
+      items, graph = self.build_graph(self.configs, is_iis_search = False)
+      fingerprint = self.fingerprint(items, graph)
+      cached_positions = self.plan_cache.get(fingerprint, graph) if self.plan_cache is not None else None
+      solution: dict[ManagedConfigItem, int] | None = dict(zip(items, cached_positions)) if cached_positions is not None else None
+      if solution is None:
+        reduced_graph = graph.transitive_reduction()
+        logger.info(f"install order: {reduced_graph.naive_constraint_count - len(reduced_graph.edges)} of {reduced_graph.naive_constraint_count} ordering constraints were redundant")
+
+        # interchangeable items get merged into one node, which is represented by the first of its items
+        contracted_graph, node_to_contracted = reduced_graph.contract_interchangeable()
+        first_items: dict[int, ManagedConfigItem] = {}
+        for node, contracted_node in enumerate(node_to_contracted):
+          first_items.setdefault(contracted_node, items[node])
+        representatives = [first_items[contracted_node] for contracted_node in range(contracted_graph.size)]
+        logger.info(f"install order: {len(items)} items were contracted into {contracted_graph.size} nodes")
+        contracted_solution: dict[ManagedConfigItem, int] | None = None
+        if self.strategy == "graph" and not self.checkpoint_barriers:
+          contracted_solution = self.solve_graph(representatives, contracted_graph)
+        if contracted_solution is None:
+          contracted_solution = self.solve_stages(representatives, contracted_graph)
+        solution = {item: contracted_solution[representatives[node_to_contracted[node]]] for node, item in enumerate(items)}
+      if self.plan_cache is not None and cached_positions is None and not self.limits_reached:
+        self.plan_cache.put(fingerprint, [solution[item] for item in items])
     finally:
       print()
 
-    execution_group_count = max(solution.values()) + 1
-    execution_groups: list[list[ManagedConfigItem]] = [[] for i in range(execution_group_count)]
+    # the solver may leave gaps between steps, so positions get renumbered consecutively
+    positions = sorted(set(solution.values()))
+    group_for_position = {position: idx for idx, position in enumerate(positions)}
+    execution_groups: list[list[ManagedConfigItem]] = [[] for i in range(len(positions))]
     for config in self.configs:
       for item in config:
-        execution_groups[solution[item]].append(item)
+        execution_groups[group_for_position[solution[item]]].append(item)
 
     # Der Optimierungs-Algorithmus arbeitet unter der Annahme, dass Items innerhalb einer Gruppe beliebig
     # umsortiert werden dürfen. Das kann im Endergebnis u.U. problematisch sein, z.B. wenn man zwei PostHooks
@@ -78,72 +308,278 @@ class InstallPhaseOptimizer:
 
     return [
       InstallStep(manager = self.manager_for(group[0]), items_to_install = group)
-      for group in execution_groups
+      for group in execution_groups if group
     ]
 
-  def solve(
-    self,
-    is_iis_search: bool,
-    configs: Sequence[Sequence[ManagedConfigItem]],
-    extra_constraints: ExtraConstraints = ExtraConstraints(),
-  ) -> dict[ManagedConfigItem, int]:
-    model = Model("koti")
-    objective = model.addVar("objective", vtype = "I")
+  def fingerprint(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> str:
+    """Canonical hash of the config structure: the grouped item identities, the manager class of each
+    item and the resolved ordering constraints, plus all options that influence the calculated install order.
+    Two runs with the same fingerprint have the same install order."""
+    manager_classes = [f"{manager.__class__.__module__}.{manager.__class__.__qualname__}" for manager in self.managers]
+    structure = {
+      "groups": [[str(items[node]) for node in group] for group in graph.groups],
+      "managers": [manager_classes[idx] for idx in graph.managers],
+      "edges": sorted([node1, node2, weight] for (node1, node2), weight in graph.edges.items()),
+      "costs": self.manager_costs,
+      "checkpoint_barriers": self.checkpoint_barriers,
+      "strategy": self.strategy,
+      "incremental": self.incremental,
+      "time_limit": self.time_limit,
+      "gap_limit": self.gap_limit,
+    }
+    return sha256(json.dumps(structure).encode()).hexdigest()
+
+  def solve_graph(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> dict[ManagedConfigItem, int] | None:
+    """Calculates the install order by greedily layering the dependency graph. Returns None if the
+    result cannot be proven optimal (or the graph contains cycles), so the solver has to take over."""
+    positions = self.cheapest_greedy_layers(graph)
+    if positions is None and graph.find_infeasible_cycle() is not None:
+      raise InfeasibleError()
+    if positions is None or graph.cost(positions, self.manager_costs) > graph.cost_lower_bound(self.manager_costs):
+      return None
+    return dict(zip(items, positions))
+
+  def cheapest_greedy_layers(self, graph: InstallGraph) -> list[int] | None:
+    """Runs both greedy strategies (critical path first and cheapest manager first), returns the cheaper result."""
+    candidates = [positions for positions in [graph.greedy_layers(), graph.greedy_layers(self.manager_costs)] if positions is not None]
+    return min(candidates, key = lambda positions: (graph.cost(positions, self.manager_costs), max(positions, default = 0)), default = None)
+
+  def solve_stages(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> dict[ManagedConfigItem, int]:
+    """If checkpoint_barriers is enabled, each Checkpoint acts as a global barrier: the Checkpoint and everything
+    ordered before it gets installed before all remaining items. Each stage is then optimized on its own, so
+    e.g. the bootstrap stage doesn't have to be solved together with all later items."""
+    barriers = [node for node, item in enumerate(items) if isinstance(item, Checkpoint)] if self.checkpoint_barriers else []
+    if not barriers or graph.topological_order() is None:
+      return self.solve_components(items, graph)
+    stages = graph.stages(barriers)
+    logger.info(f"install order: solving {len(stages)} stages separated by checkpoints")
+    result: dict[ManagedConfigItem, int] = {}
+    offset = 0
+    for stage in stages:
+      solution = self.solve_components([items[node] for node in stage], graph.subgraph(stage))
+      positions = sorted(set(solution.values()))
+      layer_for_position = {position: offset + idx for idx, position in enumerate(positions)}
+      result.update((item, layer_for_position[position]) for item, position in solution.items())
+      offset += len(positions)
+    return result
 
-    # create a variable for each item
-    items: list[ManagedConfigItem] = list(dict.fromkeys([item for config in configs for item in config]))
-    item_to_pos_var: dict[ConfigItem, Variable] = {}
-    for other in items:
-      item_to_pos_var[other] = model.addVar(vtype = "I")
+  def solve_components(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> dict[ManagedConfigItem, int]:
+    """Splits the graph into independent components and solves each of them separately, so the solver only ever
+    sees the largest component instead of the whole config. Afterwards, the steps of all components get merged
+    so that steps of the same manager are shared (see merge_manager_sequences). Merging optimal orders of the
+    components does not necessarily yield an optimal order of the whole graph, so the merged order is then
+    improved with respect to the invocation costs of the whole graph (which is fast if it already is optimal)."""
+    components = graph.components()
+    if len(components) == 1:
+      return self.solve_component(items, graph)
+    logger.info(f"install order: solving {len(components)} independent components (largest has {max(len(component) for component in components)} items)")
+
+    manager_sequences: list[list[int]] = []
+    component_layers: list[list[int]] = []
+    for component in components:
+      component_items = [items[node] for node in component]
+      solution = self.solve_component(component_items, graph.subgraph(component))
+
+      # the solver may leave gaps between steps, so positions get renumbered consecutively
+      positions = sorted(set(solution.values()))
+      layer_for_position = {position: idx for idx, position in enumerate(positions)}
+      layers = [layer_for_position[solution[item]] for item in component_items]
+      manager_sequence = [-1] * len(positions)
+      for node, layer in zip(component, layers):
+        manager_sequence[layer] = graph.managers[node]
+      manager_sequences.append(manager_sequence)
+      component_layers.append(layers)
+
+    merged, mappings = merge_manager_sequences(manager_sequences, self.manager_costs)
+    result: dict[ManagedConfigItem, int] = {}
+    for component, layers, mapping in zip(components, component_layers, mappings):
+      for node, layer in zip(component, layers):
+        result[items[node]] = mapping[layer]
+    return self.improve_solution(items, graph, result)
+
+  def solve_component(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> dict[ManagedConfigItem, int]:
+    solution = self.solve_graph(items, graph) if self.strategy == "graph" else None
+    if solution is None:
+      solution = self.solve_iteratively(items, graph)
+
+      if solution is None:
+        solution = self.fallback_solution(items, graph, self.cheapest_greedy_layers(graph))
+      # this solver only minimizes the number of steps, so the invocation costs still have to be minimized
+      solution = self.improve_solution(items, graph, solution)
+    return solution
+
+  def improve_solution(self, items: Sequence[ManagedConfigItem], graph: InstallGraph, solution: dict[ManagedConfigItem, int]) -> dict[ManagedConfigItem, int]:
+    """Replaces the solution by the greedy layering if that is cheaper, then minimizes the invocation costs with
+    as many steps as the longer one of both orders has."""
+    greedy_positions = self.cheapest_greedy_layers(graph)
+    if greedy_positions is not None and graph.cost(greedy_positions, self.manager_costs) < graph.cost([solution[item] for item in items], self.manager_costs):
+      solution = dict(zip(items, greedy_positions))
+    max_steps = max(len(set(solution.values())), max(greedy_positions, default = 0) + 1 if greedy_positions is not None else 0)
+    return self.minimize_invocation_costs(items, graph, solution, max_steps)
+
+  def minimize_invocation_costs(self, items: Sequence[ManagedConfigItem], graph: InstallGraph, solution: dict[ManagedConfigItem, int], max_steps: int) -> dict[ManagedConfigItem, int]:
+    """Improves a valid install order with respect to the total invocation cost, considering all install orders with
+    up to max_steps steps (see InvocationCostModel). Returns the given order if the solver finds nothing better
+    within the time/gap limits."""
+    positions = sorted(set(solution.values()))
+    layer_for_position = {position: idx for idx, position in enumerate(positions)}
+    layers = [layer_for_position[solution[item]] for item in items]
+    if graph.topological_order() is not None and graph.cost(layers, self.manager_costs) <= graph.cost_lower_bound(self.manager_costs):
+      return solution  # already optimal
+
+    cost_model = InvocationCostModel(graph, self.manager_costs, max_steps)
+    cost_model.add_primal_start(layers)
+    improved = self.optimize(cost_model.model, dict(zip(items, cost_model.pos_vars)))
+    if improved is None or graph.cost([improved[item] for item in items], self.manager_costs) >= graph.cost(layers, self.manager_costs):
+      return solution
+    return improved
+
+  def fallback_solution(self, items: Sequence[ManagedConfigItem], graph: InstallGraph, greedy_positions: list[int] | None) -> dict[ManagedConfigItem, int]:
+    """Used if the solver found no valid solution within the limits: the greedy layering (or, for graphs with
+    cycles of interchangeable items, the topological order) is always a valid, if possibly suboptimal, result."""
+    if greedy_positions is not None:
+      logger.warn(f"install order: no solution found within the solver limits, using the greedy order instead (cost {graph.cost(greedy_positions, self.manager_costs):g}, lower bound {graph.cost_lower_bound(self.manager_costs):g})")
+      return dict(zip(items, greedy_positions))
+    if graph.find_infeasible_cycle() is not None:
+      raise InfeasibleError()
+    raise AssertionError("install order could not be determined within the solver limits")
 
-    # apply constraints enforcing the order within each group
-    for config in configs:
-      last_item = config[-1]
-      pos_var = item_to_pos_var[last_item]
-      model.addCons(objective >= pos_var)  # only the last item in each group can influence the objective function
-      for idx1, item1 in enumerate(config):
-        for idx2, item2 in enumerate(config):
-          if idx1 < idx2:
-            pos1_var = item_to_pos_var[item1]
-            pos2_var = item_to_pos_var[item2]
-            abstand = 1 if self.manager_for(item1) != self.manager_for(item2) else 0
-            model.addCons(pos2_var - pos1_var >= abstand)
+  def solve_iteratively(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> dict[ManagedConfigItem, int] | None:
+    """Runs the solver repeatedly an a partially specified problem, adding additional constraints
+    to avoid undesired results whenever necessary.
+    (This is a lot faster than specifying the full-scale problem, because the number of constraints grows
+    quadratically and involves integer variables. We sacrifice a bit of optimality, but in practice, this
+    seems to be barely ever noticeable.)
+    Returns None if the time/gap limits are reached before a valid solution was found."""
+    if self.incremental:
+      return self.solve_incrementally(items, graph)
+    solution: dict[ManagedConfigItem, int] | None = {}
+    constraints: ExtraConstraints | None = ExtraConstraints()
+    while constraints is not None:
+      solution = self.solve(
+        items = items,
+        graph = graph,
+        extra_constraints = constraints,
+      )
+      if solution is None:
+        return None
+      sys.stdout.write(".")
+      sys.stdout.flush()
+      constraints = self.adjust_constraints(solution, constraints)
+    return solution
+
+  def solve_incrementally(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> dict[ManagedConfigItem, int] | None:
+    """Same as the iteration in solve_iteratively(), but keeps a single solver model alive: after each iteration,
+    only the changed ExtraConstraints get added or removed. The previous solution (and the greedy layering of the
+    graph, if available) are passed to the solver as primal start, so it doesn't have to start from scratch."""
+    model, objective, item_to_pos_var = self.create_model(items, graph)
+    greedy_positions = graph.greedy_layers()
+    greedy_solution = [dict(zip(items, greedy_positions))] if greedy_positions is not None else []
+
+    same_value_conss: dict[tuple[ManagedConfigItem, ManagedConfigItem], Cons] = {}
+    different_value_pairs_applied = 0
+    solution: dict[ManagedConfigItem, int] | None = {}
+    start_solutions: list[dict[ManagedConfigItem, int]] = greedy_solution
+    constraints: ExtraConstraints | None = ExtraConstraints()
+    while constraints is not None:
+      # same_value_groups are recalculated from scratch in each iteration, so outdated ones have to be removed
+      same_value_pairs = list(dict.fromkeys([pair for group in constraints.same_value_groups for pair in zip(group[:-1], group[1:])]))
+      for pair in [pair for pair in same_value_conss if pair not in same_value_pairs]:
+        model.delCons(same_value_conss.pop(pair))
+      for item1, item2 in same_value_pairs:
+        if (item1, item2) not in same_value_conss:
+          same_value_conss[(item1, item2)] = model.addCons(item_to_pos_var[item1] == item_to_pos_var[item2])
+
+      # different_value_pairs only ever get appended
+      for item1, item2 in constraints.different_value_pairs[different_value_pairs_applied:]:
+        model.addCons(abs(item_to_pos_var[item1] - item_to_pos_var[item2]) >= 1)
+      different_value_pairs_applied = len(constraints.different_value_pairs)
+
+      for start_solution in start_solutions:
+        self.add_primal_start(model, objective, item_to_pos_var, start_solution)
+      solution = self.optimize(model, item_to_pos_var)
+      if solution is None:
+        return None
+      sys.stdout.write(".")
+      sys.stdout.flush()
+      constraints = self.adjust_constraints(solution, constraints)
+      if constraints is not None:
+        model.freeTransform()  # return to problem stage, so constraints can be modified again
+        start_solutions = [solution, *greedy_solution]
+    return solution
+
+  def build_graph(self, configs: Sequence[Sequence[ManagedConfigItem]], is_iis_search: bool) -> tuple[list[ManagedConfigItem], InstallGraph]:
+    """Translates the configs into an InstallGraph. The returned item list maps node indices to items."""
+    items: list[ManagedConfigItem] = list(dict.fromkeys([item for config in configs for item in config]))
+    item_to_node: dict[ManagedConfigItem, int] = {item: idx for idx, item in enumerate(items)}
+    manager_to_idx: dict[ConfigManager, int] = {manager: idx for idx, manager in enumerate(self.managers)}
 
     # apply constraints that are defined by the items themselves
     # (if there is a dependency between two items, they should NEVER end up in the same group, or else their
     # manager would later be allowed to rearrange them - which in rare cases could break the user intention)
+    edges: dict[tuple[int, int], int] = {}
     for subject in items:
-      subject_pos = item_to_pos_var[subject]
+      subject_node = item_to_node[subject]
 
       # add "requires" constraints
       for required_item in subject.requires:
-        other_pos = item_to_pos_var.get(required_item, None)
-        if other_pos is not None:
-          model.addCons(subject_pos - other_pos >= 1)
+        other_node = item_to_node.get(required_item, None)
+        if other_node is not None:
+          edges[(other_node, subject_node)] = 1
         elif not is_iis_search:
           raise AssertionError(f"{subject}: required item {required_item} not found")
 
       # add "after" constraints
       for after_element in subject.after:
         if isinstance(after_element, ManagedConfigItem):
-          other_pos = item_to_pos_var.get(after_element, None)
-          if other_pos is not None:
-            model.addCons(subject_pos - other_pos >= 1)
+          other_node = item_to_node.get(after_element, None)
+          if other_node is not None:
+            edges[(other_node, subject_node)] = 1
         else:
-          for other in [other for other in items if other != subject and after_element(other)]:
-            other_pos = item_to_pos_var.get(other, None)
-            model.addCons(subject_pos - other_pos >= 1)
+          for other in self.resolve_selector(after_element):
+            other_node = item_to_node.get(other, None)
+            if other_node is not None and other != subject:
+              edges[(other_node, subject_node)] = 1
 
       # add "before" constraints
       for before_element in subject.before:
         if isinstance(before_element, ManagedConfigItem):
-          other_pos = item_to_pos_var.get(before_element, None)
-          if other_pos is not None:
-            model.addCons(other_pos - subject_pos >= 1)
+          other_node = item_to_node.get(before_element, None)
+          if other_node is not None:
+            edges[(subject_node, other_node)] = 1
         else:
-          for other in [other for other in items if other != subject and before_element(other)]:
-            other_pos = item_to_pos_var[other]
-            model.addCons(other_pos - subject_pos >= 1)
+          for other in self.resolve_selector(before_element):
+            other_node = item_to_node.get(other, None)
+            if other_node is not None and other != subject:
+              edges[(subject_node, other_node)] = 1
+
+    graph = InstallGraph.from_groups(
+      managers = [manager_to_idx[self.manager_for(item)] for item in items],
+      groups = [[item_to_node[item] for item in config] for config in configs],
+      edges = edges,
+    )
+    return items, graph
+
+  def resolve_selector(self, selector: Callable[[ManagedConfigItem], bool]) -> list[ManagedConfigItem]:
+    """Returns all items matching a before/after selector. Selector objects are resolved via the item index,
+    plain callables are evaluated once per item. Either way the result is memoized, so subsequent solver
+    iterations and IIS probes don't have to evaluate them again."""
+    result = self.resolved_selectors.get(selector, None)
+    if result is None:
+      if isinstance(selector, Selector):
+        result = self.item_index.ordered(selector.resolve(self.item_index))
+      else:
+        result = [item for item in self.item_index.items if selector(item)]
+      self.resolved_selectors[selector] = result
+    return result
+
+  def solve(
+    self,
+    items: Sequence[ManagedConfigItem],
+    graph: InstallGraph,
+    extra_constraints: ExtraConstraints = ExtraConstraints(),
+  ) -> dict[ManagedConfigItem, int] | None:
+    model, objective, item_to_pos_var = self.create_model(items, graph)
 
     # apply constraints that are added during the optimization process
     for bound_group in extra_constraints.same_value_groups:
@@ -156,18 +592,41 @@ class InstallPhaseOptimizer:
       pos2 = item_to_pos_var[item2]
       model.addCons(abs(pos1 - pos2) >= 1)
 
-    model.hideOutput(True)
-    model.setMinimize()
-    model.setObjective(objective)
-    if is_iis_search:
-      model.setEmphasis(SCIP_PARAMEMPHASIS.FEASIBILITY)
+    return self.optimize(model, item_to_pos_var)
+
+  def create_model(self, items: Sequence[ManagedConfigItem], graph: InstallGraph) -> tuple[Model, Variable, dict[ManagedConfigItem, Variable]]:
+    """Sets up a solver model containing all constraints of the graph (but none of the ExtraConstraints).
+    The graph should be transitively reduced beforehand to keep the number of constraints small."""
+    model, objective, pos_vars = create_solver_model(graph, is_iis_search = False)
+    return model, objective, dict(zip(items, pos_vars))
+
+  def optimize(self, model: Model, item_to_pos_var: dict[ManagedConfigItem, Variable]) -> dict[ManagedConfigItem, int] | None:
+    """Runs the solver within the remaining time. Returns None if no solution was found before hitting the limits."""
+    remaining_time = self.deadline - time.monotonic() if self.deadline is not None else None
+    if remaining_time is not None and remaining_time <= 0:
+      self.limits_reached = True
+      return None
+    apply_solver_limits(model, remaining_time, self.gap_limit)
     model.optimize()
-    sol = model.getBestSol()
 
     if model.getStatus() == "infeasible":
       raise InfeasibleError()
+    if stopped_at_limit(model, "install order"):
+      self.limits_reached = True
+    if model.getNSols() == 0:
+      return None
 
-    return dict((item, round(sol[item_to_pos_var[item]])) for item in items)
+    sol = model.getBestSol()
+    return dict((item, round(sol[pos_var])) for item, pos_var in item_to_pos_var.items())
+
+  @classmethod
+  def add_primal_start(cls, model: Model, objective: Variable, item_to_pos_var: dict[ManagedConfigItem, Variable], positions: dict[ManagedConfigItem, int]):
+    """Hands a known assignment to the solver as starting point. Infeasible assignments are simply discarded by SCIP."""
+    sol = model.createSol()
+    for item, pos_var in item_to_pos_var.items():
+      model.setSolVal(sol, pos_var, positions[item])
+    model.setSolVal(sol, objective, max(positions.values(), default = 0))
+    model.addSol(sol)
 
   def adjust_constraints(
     self,
@@ -199,25 +658,71 @@ class InstallPhaseOptimizer:
       return None
 
   def find_iis(self) -> Sequence[ManagedConfigItem]:
+    """Calculates a minimal set of items that cannot be ordered consistently. Almost always this is caused by a
+    circular dependency, which can be found directly in the graph. Only if there is none, items are removed
+    chunk by chunk while checking the remaining items with the solver."""
+    items, graph = self.build_graph(self.configs, is_iis_search = True)
+    cycle = graph.find_infeasible_cycle()
+    if cycle is not None:
+      return [items[node] for node in cycle]
+
     sys.stdout.write("calculating irreducible infeasible subset...")
     sys.stdout.flush()
     configs: Sequence[Sequence[ManagedConfigItem]] = self.configs
 
-    # successively remove items in chunks and check feasibility
-    chunk_size = ceil(len({item for config in configs for item in config}) / 2)
-    while True:
-      for chunk in self.chunks([item for config in configs for item in config], chunk_size):
-        reduced_config = self.remove_items(configs, lambda x: x in chunk)
-        if not self.is_feasible(reduced_config):
-          configs = reduced_config
+    # successively remove items in chunks and check feasibility. The checks for consecutive chunks are run
+    # speculatively in parallel (all based on the current configs), then evaluated in order: as soon as one chunk
+    # is accepted for removal, the results for subsequent chunks are outdated and have to be checked again.
+    # This yields exactly the same result as checking one chunk after another.
+    executor = ProcessPoolExecutor(max_workers = self.iis_workers) if self.iis_workers > 1 else None
+    try:
+      chunk_size = ceil(len({item for config in configs for item in config}) / 2)
+      while True:
+        pending_chunks = list(self.chunks([item for config in configs for item in config], chunk_size))
+        while pending_chunks:
+          batch = pending_chunks[:max(1, self.iis_workers)]
+          reduced_configs = [self.remove_items(configs, lambda x: x in chunk) for chunk in batch]
+          results = self.probe_feasibility(reduced_configs, executor)
+          accepted = next((idx for idx, feasible in enumerate(results) if not feasible), None)
+          if accepted is None:
+            pending_chunks = pending_chunks[len(batch):]
+            continue
+          configs = reduced_configs[accepted]
+          pending_chunks = pending_chunks[accepted + 1:]
           sys.stdout.write(".")
           sys.stdout.flush()
-      if chunk_size == 1: break
-      chunk_size = ceil(chunk_size / 2)
+        if chunk_size == 1: break
+        chunk_size = ceil(chunk_size / 2)
+    finally:
+      if executor is not None:
+        executor.shutdown()
 
     print()
     return list(dict.fromkeys([item for config in configs for item in config]))
 
+  def probe_feasibility(self, candidates: Sequence[Sequence[Sequence[ManagedConfigItem]]], executor: Executor | None) -> list[bool]:
+    """Checks several configs for feasibility (in parallel, if an executor is given). Results are memoized. Since
+    removing items can never make a feasible config infeasible, known results also apply to subsets/supersets."""
+    keys = [frozenset(item for config in candidate for item in config) for candidate in candidates]
+    results: list[bool | None] = [self.lookup_feasibility(key) for key in keys]
+    unknown = [idx for idx, result in enumerate(results) if result is None]
+    graphs = [self.build_graph(candidates[idx], is_iis_search = True)[1] for idx in unknown]
+    outcomes = executor.map(is_feasible_graph, graphs) if executor is not None else map(is_feasible_graph, graphs)
+    for idx, outcome in zip(unknown, outcomes):
+      results[idx] = outcome
+      self.known_feasibility[keys[idx]] = outcome
+    return [result is True for result in results]
+
+  def lookup_feasibility(self, items: frozenset[ManagedConfigItem]) -> bool | None:
+    if items in self.known_feasibility:
+      return self.known_feasibility[items]
+    for known_items, feasible in self.known_feasibility.items():
+      if feasible and items <= known_items:
+        return True
+      if not feasible and known_items <= items:
+        return False
+    return None
+
   @classmethod
   def remove_items(cls, configs: Sequence[Sequence[ManagedConfigItem]], condition: Callable[[ManagedConfigItem], bool]) -> Sequence[Sequence[ManagedConfigItem]]:
     result: list[Sequence[ManagedConfigItem]] = []
@@ -231,17 +736,10 @@ class InstallPhaseOptimizer:
     return result
 
   def is_feasible(self, configs: Sequence[Sequence[ManagedConfigItem]]) -> bool:
-    try:
-      self.solve(configs = configs, is_iis_search = True)
-      return True
-    except InfeasibleError:
-      return False
+    return self.probe_feasibility([configs], executor = None)[0]
 
-  def manager_for(self, item: ConfigItem) -> ConfigManager:
-    for manager in self.managers:
-      if item.__class__ in manager.managed_classes:
-        return manager
-    raise AssertionError(f"no manager found for {item}")
+  def manager_for(self, item: ManagedConfigItem) -> ConfigManager:
+    return self.managers.manager_for(item)
 
   @classmethod
   def chunks(cls, lst: Sequence[ConfigItem], n: int):
@@ -251,9 +749,13 @@ class InstallPhaseOptimizer:
 
 class CleanupPhaseOptimizer:
   managers: Sequence[ConfigManager]
+  time_limit: float | None
+  gap_limit: float | None
 
-  def __init__(self, managers: Sequence[ConfigManager]):
+  def __init__(self, managers: Sequence[ConfigManager], time_limit: float | None = None, gap_limit: float | None = None):
     self.managers = managers
+    self.time_limit = time_limit
+    self.gap_limit = gap_limit
 
   def calc_cleanup_order(self) -> Sequence[ConfigManager]:
     model = Model("koti")
@@ -285,14 +787,49 @@ class CleanupPhaseOptimizer:
     model.hideOutput(True)
     model.setMinimize()
     model.setObjective(objective)
+    apply_solver_limits(model, self.time_limit, self.gap_limit)
     model.optimize()
-    sol = model.getBestSol()
 
     if model.getStatus() == "infeasible":
       raise InfeasibleError()
+    stopped_at_limit(model, "cleanup order")
 
     # sort managers according to the optimization result
-    manager_classes_ordered.sort(key = lambda cls: round(sol[next((var for key, var in manager_to_pos_var if key == cls))]))
+    if model.getNSols() > 0:
+      sol = model.getBestSol()
+      manager_classes_ordered.sort(key = lambda cls: round(sol[next((var for key, var in manager_to_pos_var if key == cls))]))
+    else:
+      logger.warn("cleanup order: no solution found within the solver limits, using the numeric cleanup_order instead")
+      manager_classes_ordered = self.fallback_order(manager_classes_ordered)
 
     # sort final manager list in the same order as the manager classes
     return sorted(self.managers, key = lambda m: manager_classes_ordered.index(m.__class__))
+
+  @classmethod
+  def fallback_order(cls, manager_classes: list[type[ConfigManager]]) -> list[type[ConfigManager]]:
+    """Orders the managers by their numeric cleanup_order, only deviating where cleanup_order_before /
+    cleanup_order_after demand it (Kahn's algorithm, always picking the manager that comes first numerically)."""
+    successors: dict[type[ConfigManager], set[type[ConfigManager]]] = {manager: set() for manager in manager_classes}
+    for manager in manager_classes:
+      successors[manager].update(other for other in manager.cleanup_order_before if other in successors)
+      for other in manager.cleanup_order_after:
+        if other in successors:
+          successors[other].add(manager)
+    indegree = {manager: 0 for manager in manager_classes}
+    for manager in manager_classes:
+      for other in successors[manager]:
+        indegree[other] += 1
+
+    result: list[type[ConfigManager]] = []
+    available = [manager for manager in manager_classes if indegree[manager] == 0]
+    while available:
+      manager = min(available, key = manager_classes.index)
+      available.remove(manager)
+      result.append(manager)
+      for other in successors[manager]:
+        indegree[other] -= 1
+        if indegree[other] == 0:
+          available.append(other)
+    if len(result) != len(manager_classes):
+      raise InfeasibleError()
+    return result
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+from typing import Iterable, Type
+
+from koti.model import ManagedConfigItem
+
+
+class ItemIndex:
+  """Lookup tables over a fixed set of items, used to resolve Selectors without inspecting every item."""
+  items: list[ManagedConfigItem]
+  positions: dict[ManagedConfigItem, int]
+  by_class: dict[type, list[ManagedConfigItem]]
+  by_tag: dict[str, list[ManagedConfigItem]]
+
+  def __init__(self, items: Iterable[ManagedConfigItem]):
+    self.items = list(dict.fromkeys(items))
+    self.positions = {item: idx for idx, item in enumerate(self.items)}
+    self.by_class = defaultdict(list)
+    self.by_tag = defaultdict(list)
+    for item in self.items:
+      self.by_class[item.__class__].append(item)
+      for tag in item.tags:
+        self.by_tag[tag].append(item)
+
+  def ordered(self, items: set[ManagedConfigItem]) -> list[ManagedConfigItem]:
+    """Returns the given items in the order of the index."""
+    return sorted(items, key = lambda item: self.positions[item])
+
+
+class Selector(metaclass = ABCMeta):
+  """Declarative replacement for lambdas in before/after, e.g. `before = OfType(Package) & ~Tagged("bootstrap")`.
+  Selectors are callable like a lambda, but can also be resolved against an ItemIndex, which koti does
+  once per run instead of evaluating them for every pair of items."""
+
+  @abstractmethod
+  def __call__(self, item: ManagedConfigItem) -> bool:
+    pass
+
+  @abstractmethod
+  def resolve(self, index: ItemIndex) -> set[ManagedConfigItem]:
+    """Returns all items of the index that match the selector."""
+    pass
+
+  def __and__(self, other: Selector) -> Selector:
+    return And(self, other)
+
+  def __or__(self, other: Selector) -> Selector:
+    return Or(self, other)
+
+  def __invert__(self) -> Selector:
+    return Not(self)
+
+
+class OfType(Selector):
+  """Matches items that are instances of any of the given classes (subclasses included)."""
+  classes: tuple[Type[ManagedConfigItem], ...]
+
+  def __init__(self, *classes: Type[ManagedConfigItem]):
+    self.classes = classes
+
+  def __call__(self, item: ManagedConfigItem) -> bool:
+    return isinstance(item, self.classes)
+
+  def resolve(self, index: ItemIndex) -> set[ManagedConfigItem]:
+    return {item for cls, items in index.by_class.items() if issubclass(cls, self.classes) for item in items}
+
+  def __repr__(self) -> str:
+    return f"OfType({", ".join(cls.__name__ for cls in self.classes)})"
+
+
+class Tagged(Selector):
+  """Matches items that have any of the given tags."""
+  tags: tuple[str, ...]
+
+  def __init__(self, *tags: str):
+    self.tags = tags
+
+  def __call__(self, item: ManagedConfigItem) -> bool:
+    return any(tag in item.tags for tag in self.tags)
+
+  def resolve(self, index: ItemIndex) -> set[ManagedConfigItem]:
+    return {item for tag in self.tags for item in index.by_tag.get(tag, [])}
+
+  def __repr__(self) -> str:
+    return f"Tagged({", ".join(repr(tag) for tag in self.tags)})"
+
+
+class Not(Selector):
+  selector: Selector
+
+  def __init__(self, selector: Selector):
+    self.selector = selector
+
+  def __call__(self, item: ManagedConfigItem) -> bool:
+    return not self.selector(item)
+
+  def resolve(self, index: ItemIndex) -> set[ManagedConfigItem]:
+    return set(index.items).difference(self.selector.resolve(index))
+
+  def __repr__(self) -> str:
+    return f"~{self.selector}"
+
+
+class And(Selector):
+  selectors: tuple[Selector, ...]
+
+  def __init__(self, *selectors: Selector):
+    assert len(selectors) > 0, "And() needs at least one selector"
+    self.selectors = selectors
+
+  def __call__(self, item: ManagedConfigItem) -> bool:
+    return all(selector(item) for selector in self.selectors)
+
+  def resolve(self, index: ItemIndex) -> set[ManagedConfigItem]:
+    return set.intersection(*(selector.resolve(index) for selector in self.selectors))
+
+  def __repr__(self) -> str:
+    return f"({" & ".join(str(selector) for selector in self.selectors)})"
+
+
+class Or(Selector):
+  selectors: tuple[Selector, ...]
+
+  def __init__(self, *selectors: Selector):
+    self.selectors = selectors
+
+  def __call__(self, item: ManagedConfigItem) -> bool:
+    return any(selector(item) for selector in self.selectors)
+
+  def resolve(self, index: ItemIndex) -> set[ManagedConfigItem]:
+    return set().union(*(selector.resolve(index) for selector in self.selectors))
+
+  def __repr__(self) -> str:
+    return f"({" | ".join(str(selector) for selector in self.selectors)})"
@@ -0,0 +1,324 @@
+from __future__ import annotations
+
+import fcntl
+import grp
+import os
+import pwd
+import shutil
+import time
+from typing import Any, Callable
+
+from koti.utils.shell import invalidate_user_contexts, run_success
+
+
+class PasswdEntry:
+  """An entry of the user database (usually a line of /etc/passwd)."""
+  name: str
+  uid: int
+  gid: int
+  home: str
+  shell: str
+
+  def __init__(self, name: str, uid: int, gid: int, home: str, shell: str):
+    self.name = name
+    self.uid = uid
+    self.gid = gid
+    self.home = home
+    self.shell = shell
+
+
+class GroupEntry:
+  """An entry of the group database (usually a line of /etc/group)."""
+  name: str
+  gid: int
+  members: list[str]
+
+  def __init__(self, name: str, gid: int, members: list[str]):
+    self.name = name
+    self.gid = gid
+    self.members = members
+
+
+class AccountDatabase:
+  """Parses /etc/passwd, /etc/group and /etc/shadow instead of spawning getent/passwd for every lookup. The parsed
+  files are kept until their mtime changes (or invalidate() is called after an action that changed accounts), so a
+  whole phase usually reads each of them once. Accounts from other NSS sources (e.g. LDAP or systemd-homed) are
+  enumerated via pwd.getpwall()/grp.getgrall() and added to the listings; entries in the files take precedence.
+  These are kept until invalidate() is called."""
+  path: str
+  files: dict[str, tuple[int | None, list[list[str]] | None]]
+  nss_users: dict[str, PasswdEntry] | None
+  nss_groups: dict[str, GroupEntry] | None
+
+  def __init__(self, path: str = "/etc"):
+    self.path = path
+    self.files = {}
+    self.nss_users = None
+    self.nss_groups = None
+
+  def users(self) -> dict[str, PasswdEntry]:
+    result: dict[str, PasswdEntry] = {}
+    for fields in self.read("passwd") or []:
+      if len(fields) >= 7 and fields[2].isdigit() and fields[3].isdigit():
+        result.setdefault(fields[0], PasswdEntry(fields[0], int(fields[2]), int(fields[3]), fields[5], fields[6]))
+    if self.nss_users is None:
+      self.nss_users = {entry.pw_name: PasswdEntry(entry.pw_name, entry.pw_uid, entry.pw_gid, entry.pw_dir, entry.pw_shell) for entry in pwd.getpwall()}
+    for name, entry in self.nss_users.items():
+      result.setdefault(name, entry)
+    return result
+
+  def groups(self) -> dict[str, GroupEntry]:
+    result: dict[str, GroupEntry] = {}
+    for fields in self.read("group") or []:
+      if len(fields) >= 4 and fields[2].isdigit():
+        result.setdefault(fields[0], GroupEntry(fields[0], int(fields[2]), [member for member in fields[3].split(",") if member]))
+    if self.nss_groups is None:
+      self.nss_groups = {entry.gr_name: GroupEntry(entry.gr_name, entry.gr_gid, list(entry.gr_mem)) for entry in grp.getgrall()}
+    for name, entry in self.nss_groups.items():
+      result.setdefault(name, entry)
+    return result
+
+  def user(self, username: str) -> PasswdEntry:
+    """Like pwd.getpwnam(), raises a KeyError for unknown users."""
+    entry = self.users().get(username, None)
+    if entry is not None:
+      return entry
+    pwnam = pwd.getpwnam(username)
+    return PasswdEntry(pwnam.pw_name, pwnam.pw_uid, pwnam.pw_gid, pwnam.pw_dir, pwnam.pw_shell)
+
+  def user_by_uid(self, uid: int) -> PasswdEntry:
+    """Like pwd.getpwuid(), raises a KeyError for unknown uids."""
+    for entry in self.users().values():
+      if entry.uid == uid:
+        return entry
+    pwuid = pwd.getpwuid(uid)
+    return PasswdEntry(pwuid.pw_name, pwuid.pw_uid, pwuid.pw_gid, pwuid.pw_dir, pwuid.pw_shell)
+
+  def groups_of(self, username: str) -> list[str]:
+    """Returns the groups in which the user is listed as a member (not including the primary group)."""
+    return [group.name for group in self.groups().values() if username in group.members]
+
+  def password_status(self) -> dict[str, str] | None:
+    """Returns the password status of all users in /etc/shadow with the same codes as `passwd --status` (P for a
+    usable password, L for a locked account, NP for no password), or None if /etc/shadow can't be read."""
+    shadow = self.read("shadow")
+    if shadow is None:
+      return None
+    result: dict[str, str] = {}
+    for fields in shadow:
+      if len(fields) >= 2:
+        password = fields[1]
+        result.setdefault(fields[0], "NP" if password == "" else "L" if password.startswith(("!", "*")) else "P")
+    return result
+
+  def invalidate(self):
+    self.files.clear()
+    self.nss_users = None
+    self.nss_groups = None
+    invalidate_user_contexts()  # groups, home or shell of a user might have changed
+
+  def transaction(self) -> AccountTransaction:
+    return AccountTransaction(self)
+
+  def read(self, filename: str) -> list[list[str]] | None:
+    path = os.path.join(self.path, filename)
+    try:
+      mtime: int | None = os.stat(path).st_mtime_ns
+    except OSError:
+      mtime = None
+    cached = self.files.get(filename, None)
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+    try:
+      with open(path, "r", encoding = "utf-8", errors = "replace") as file:
+        lines: list[list[str]] | None = [line.split(":") for line in file.read().splitlines() if line and not line.startswith("#")]
+    except OSError:
+      lines = None  # e.g. /etc/shadow when not running as root
+    self.files[filename] = (mtime, lines)
+    return lines
+
+
+class AccountTransaction:
+  """Collects changes to /etc/passwd, /etc/group and /etc/gshadow and applies all of them at once: the files are
+  locked the same way shadow-utils does it (lckpwdf() plus <file>.lock), modified in memory and replaced atomically,
+  instead of running one usermod/gpasswd per change (each of which rewrites the files on its own). Like shadow-utils,
+  the previous contents are kept as <file>- backups, and the nscd/sssd caches get invalidated afterwards.
+  All new files are written before the first one replaces its original, so a failure while writing leaves all of
+  them untouched.
+  commit() returns False without touching anything if the changes can't be applied directly (e.g. not running as
+  root, a lock held by another process, users/groups that are not listed in the files, or group members that
+  don't exist), in which case the caller should fall back to usermod/gpasswd."""
+  database: AccountDatabase
+  passwd_changes: dict[str, dict[int, str]]
+  group_changes: dict[str, dict[str, bool]]
+
+  lock_timeout: float = 15  # same as lckpwdf()
+
+  def __init__(self, database: AccountDatabase):
+    self.database = database
+    self.passwd_changes = {}
+    self.group_changes = {}
+
+  def set_home(self, username: str, home: str):
+    self.passwd_changes.setdefault(username, {})[5] = home
+
+  def set_shell(self, username: str, shell: str):
+    self.passwd_changes.setdefault(username, {})[6] = shell
+
+  def add_to_group(self, username: str, group: str):
+    self.group_changes.setdefault(group, {})[username] = True
+
+  def remove_from_group(self, username: str, group: str):
+    self.group_changes.setdefault(group, {})[username] = False
+
+  def commit(self) -> bool:
+    if not self.passwd_changes and not self.group_changes:
+      return True
+    filenames = [filename for filename, changed in [
+      ("passwd", bool(self.passwd_changes)),
+      ("group", bool(self.group_changes)),
+      ("gshadow", bool(self.group_changes) and os.path.exists(os.path.join(self.database.path, "gshadow"))),
+    ] if changed]
+    if not os.access(self.database.path, os.W_OK) or not all(os.access(self.path(filename), os.R_OK | os.W_OK) for filename in filenames):
+      return False
+    users = self.database.users()
+    if any(is_member and username not in users for change in self.group_changes.values() for username, is_member in change.items()):
+      return False  # gpasswd refuses to add unknown users, so let it report the error
+    lock_fd = self.lock_pwdf()
+    if lock_fd is None:
+      return False
+    file_locks: list[str] = []
+    try:
+      for filename in filenames:
+        if not self.lock_file(filename):
+          return False
+        file_locks.append(filename)
+      contents = {filename: self.read_file(filename) for filename in filenames}
+      updated: dict[str, str] = {}
+      for filename, content in contents.items():
+        if filename == "passwd":
+          result = self.apply_changes(content.splitlines(), self.passwd_changes, self.apply_passwd_change)
+        else:
+          result = self.apply_changes(content.splitlines(), self.group_changes, self.apply_group_change)
+        if result is None:
+          return False
+        updated[filename] = "".join(f"{line}\n" for line in result)
+
+      # backups first, so each file still has one if renaming the new files gets interrupted
+      staged = {f"{filename}-": content for filename, content in contents.items()} | updated
+      tmp_paths: dict[str, str] = {}
+      try:
+        for filename, content in staged.items():
+          tmp_paths[filename] = self.stage_file(filename, content, template = filename.removesuffix("-"))
+      except BaseException:
+        for tmp_path in tmp_paths.values():
+          os.unlink(tmp_path)
+        raise
+      for filename, tmp_path in tmp_paths.items():
+        os.replace(tmp_path, self.path(filename))
+      self.passwd_changes = {}
+      self.group_changes = {}
+      self.invalidate_name_service_caches()
+      return True
+    finally:
+      for filename in file_locks:
+        os.unlink(self.path(f"{filename}.lock"))
+      os.close(lock_fd)  # releases the fcntl lock
+      self.database.invalidate()
+
+  @classmethod
+  def apply_changes(cls, lines: list[str], changes: dict[str, Any], apply_change: Callable[[list[str], Any], str | None]) -> list[str] | None:
+    """Applies the changes to the lines whose first field matches, returns None if an entry is missing."""
+    result: list[str] = []
+    pending = set(changes.keys())
+    for line in lines:
+      fields = line.split(":")
+      if fields[0] in pending and not line.startswith(("#", "+", "-")):
+        pending.remove(fields[0])
+        changed = apply_change(fields, changes[fields[0]])
+        if changed is None:
+          return None
+        line = changed
+      result.append(line)
+    return result if not pending else None
+
+  @classmethod
+  def apply_passwd_change(cls, fields: list[str], change: dict[int, str]) -> str | None:
+    if len(fields) < 7:
+      return None
+    for idx, value in change.items():
+      fields[idx] = value
+    return ":".join(fields)
+
+  @classmethod
+  def apply_group_change(cls, fields: list[str], change: dict[str, bool]) -> str | None:
+    if len(fields) < 4:
+      return None
+    members = [member for member in fields[3].split(",") if member]
+    for username, is_member in change.items():
+      if is_member and username not in members:
+        members.append(username)
+      elif not is_member and username in members:
+        members.remove(username)
+    fields[3] = ",".join(members)
+    return ":".join(fields)
+
+  def path(self, filename: str) -> str:
+    return os.path.join(self.database.path, filename)
+
+  def lock_pwdf(self) -> int | None:
+    fd = os.open(self.path(".pwd.lock"), os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    deadline = time.monotonic() + self.lock_timeout
+    while True:
+      try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+      except BlockingIOError:
+        if time.monotonic() > deadline:
+          os.close(fd)
+          return None
+        time.sleep(0.1)
+
+  def lock_file(self, filename: str) -> bool:
+    try:
+      fd = os.open(self.path(f"{filename}.lock"), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+      return False  # held by another process (or stale), leave that to shadow-utils
+    with os.fdopen(fd, "w") as file:
+      file.write(str(os.getpid()))
+    return True
+
+  def read_file(self, filename: str) -> str:
+    with open(self.path(filename), "r", encoding = "utf-8") as file:
+      return file.read()
+
+  def stage_file(self, filename: str, content: str, template: str) -> str:
+    """Writes the content to <file>+ with the owner and mode of the template file, returns the path of the
+    temporary file, which then has to be moved into place."""
+    stat = os.stat(self.path(template))
+    tmp_path = f"{self.path(filename)}+"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.st_mode & 0o7777)
+    try:
+      with os.fdopen(fd, "w", encoding = "utf-8") as file:
+        os.fchown(file.fileno(), stat.st_uid, stat.st_gid)
+        os.fchmod(file.fileno(), stat.st_mode & 0o7777)
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+      raise
+    return tmp_path
+
+  @classmethod
+  def invalidate_name_service_caches(cls):
+    """Same as shadow-utils does after changing the files, failures (e.g. nscd not running) are ignored."""
+    if shutil.which("nscd") is not None:
+      run_success(["nscd", "--invalidate", "passwd"])
+      run_success(["nscd", "--invalidate", "group"])
+    if shutil.which("sss_cache") is not None:
+      run_success(["sss_cache", "-U", "-G"])
+
+
+account_database = AccountDatabase()
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import re
+import shutil
+
+from koti.utils.shell import run_output
+
+
+class FlatpakInventory:
+  """Snapshot of the system-wide flatpak installation (installed apps and configured remotes), shared by the flatpak
+  managers. It is loaded lazily on first access and kept until invalidate() is called after an action that installs,
+  uninstalls or updates apps or remotes."""
+  apps: set[str] | None
+  remotes: dict[str, str] | None
+
+  def __init__(self):
+    self.apps = None
+    self.remotes = None
+
+  def available(self) -> bool:
+    # flatpak itself might be installed during the run, so this is not part of the snapshot
+    return shutil.which("flatpak") is not None
+
+  def installed_apps(self) -> set[str]:
+    if not self.available():
+      return set()
+    if self.apps is None:
+      self.apps = set(run_output(["flatpak", "--system", "list", "--app", "--columns", "application"]).splitlines())
+    return self.apps
+
+  def remote_urls(self) -> dict[str, str]:
+    if not self.available():
+      return {}
+    if self.remotes is None:
+      remotes: dict[str, str] = {}
+      for line in run_output(["flatpak", "--system", "remotes", "--columns", "name,url"]).splitlines():
+        split = re.split("\\s+", line)
+        remotes.setdefault(split[0], split[1] if len(split) > 1 else "")
+      self.remotes = remotes
+    return self.remotes
+
+  def invalidate(self):
+    self.apps = None
+    self.remotes = None
+
+
+flatpak_inventory = FlatpakInventory()
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+
+
+class LocalPackage:
+  """A package as recorded in the local pacman database."""
+  name: str
+  version: str
+  explicit: bool
+  provides: list[str]
+
+  def __init__(self, name: str, version: str, explicit: bool, provides: list[str]):
+    self.name = name
+    self.version = version
+    self.explicit = explicit
+    self.provides = provides
+
+
+class PacmanLocalDb:
+  """Reads the installed packages directly from the local pacman database (one directory per package, containing a
+  `desc` file) instead of spawning `pacman -Q`. Parsed entries are cached by the mtime of their desc file, so
+  subsequent calls only re-read packages that have been installed or changed in the meantime."""
+  path: str
+  entries: dict[str, tuple[int, LocalPackage]]
+
+  def __init__(self, path: str = "/var/lib/pacman/local"):
+    self.path = path
+    self.entries = {}
+
+  def available(self) -> bool:
+    return os.path.isdir(self.path)
+
+  def packages(self) -> dict[str, LocalPackage]:
+    entries: dict[str, tuple[int, LocalPackage]] = {}
+    with os.scandir(self.path) as directory:
+      for entry in directory:
+        if not entry.is_dir():
+          continue  # e.g. the ALPM_DB_VERSION file
+        desc_file = os.path.join(entry.path, "desc")
+        try:
+          mtime = os.stat(desc_file).st_mtime_ns
+        except FileNotFoundError:
+          continue  # package is just being installed/removed
+        cached = self.entries.get(entry.name, None)
+        if cached is not None and cached[0] == mtime:
+          entries[entry.name] = cached
+        else:
+          entries[entry.name] = (mtime, self.parse_desc(desc_file))
+    self.entries = entries
+    return {package.name: package for mtime, package in entries.values()}
+
+  def installed_packages(self) -> set[str]:
+    return set(self.packages().keys())
+
+  def explicit_packages(self) -> set[str]:
+    return {name for name, package in self.packages().items() if package.explicit}
+
+  @classmethod
+  def parse_desc(cls, desc_file: str) -> LocalPackage:
+    """Parses a desc file, which consists of blocks like "%NAME%\\npackage-name\\n\\n". A missing %REASON% means
+    that the package has been installed explicitly (0), 1 means it has been installed as a dependency."""
+    fields: dict[str, list[str]] = {}
+    current: list[str] | None = None
+    with open(desc_file, "r", encoding = "utf-8", errors = "replace") as file:
+      for line in file.read().splitlines():
+        if line.startswith("%") and line.endswith("%") and len(line) > 2:
+          current = fields.setdefault(line[1:-1], [])
+        elif not line:
+          current = None
+        elif current is not None:
+          current.append(line)
+    return LocalPackage(
+      name = fields.get("NAME", [""])[0],
+      version = fields.get("VERSION", [""])[0],
+      explicit = fields.get("REASON", ["0"])[0] != "1",
+      provides = fields.get("PROVIDES", []),
+    )
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from subprocess import CalledProcessError
+
+from koti.utils.logging import logger
+from koti.utils.shell import run_output, run_success
+
+
+class PacmanKeyring:
+  """Snapshot of the key ids and fingerprints in the pacman keyring, parsed from a single
+  `gpg --list-keys --with-colons` call on the keyring directory (pacman-key itself doesn't accept --with-colons).
+  It is kept until invalidate() is called after keys have been added. If the keyring can't be listed (e.g. it has
+  not been initialized yet), there is no snapshot and each key gets checked via `pacman-key --list-keys` instead."""
+  gnupg_home: str
+  key_ids: set[str] | None
+  is_listed: bool
+
+  def __init__(self, gnupg_home: str = "/etc/pacman.d/gnupg"):
+    self.gnupg_home = gnupg_home
+    self.key_ids = None
+    self.is_listed = False
+
+  def contains(self, key_id: str) -> bool:
+    """Accepts fingerprints as well as long or short key ids, with or without 0x prefix or spaces."""
+    return self.is_contained(key_id, self.keys())
+
+  def keys(self) -> set[str] | None:
+    """Returns None if the keyring could not be listed."""
+    if not self.is_listed:
+      self.is_listed = True
+      try:
+        self.key_ids = self.parse(run_output(["gpg", "--homedir", self.gnupg_home, "--batch", "--list-keys", "--with-colons"]))
+      except (CalledProcessError, FileNotFoundError):
+        logger.warn("pacman keyring could not be listed, checking each key with pacman-key instead")
+        self.key_ids = None
+    return self.key_ids
+
+  def invalidate(self):
+    self.key_ids = None
+    self.is_listed = False
+
+  @classmethod
+  def parse(cls, output: str) -> set[str]:
+    """Collects the key ids (field 5 of pub/sub records) and fingerprints (field 10 of fpr records)."""
+    result: set[str] = set()
+    for line in output.splitlines():
+      fields = line.split(":")
+      if fields[0] in ("pub", "sub") and len(fields) > 4 and fields[4]:
+        result.add(fields[4].upper())
+      elif fields[0] == "fpr" and len(fields) > 9 and fields[9]:
+        result.add(fields[9].upper())
+    return result
+
+  @classmethod
+  def is_contained(cls, key_id: str, keys: set[str] | None) -> bool:
+    """Checks a key id against a set of keys returned by keys(), so multiple lookups can share one snapshot."""
+    normalized = cls.normalize(key_id)
+    if not normalized:
+      return False
+    if keys is None:
+      return run_success(["pacman-key", "--list-keys", normalized])
+    return normalized in keys or any(known.endswith(normalized) for known in keys)
+
+  @classmethod
+  def normalize(cls, key_id: str) -> str:
+    normalized = key_id.replace(" ", "").upper()
+    return normalized[2:] if normalized.startswith("0X") else normalized
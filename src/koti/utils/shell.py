@@ -1,33 +1,74 @@
 from __future__ import annotations
 
-import pwd, grp, os
+import pwd, grp, os, shlex, subprocess
 from inspect import cleandoc
-from subprocess import CalledProcessError, Popen, run
+from subprocess import CalledProcessError, Popen
+from typing import Any, Sequence
 
 verbose_mode: bool = False
 
 
+class UserContext:
+  """Everything needed to run a command as another user. Determining the environment requires a login shell
+  (`su - user`), so contexts are cached per user until invalidate_user_contexts() is called after accounts changed."""
+  user: str
+  group: str
+  extra_groups: list[str]
+  env: dict[str, str]
+
+  def __init__(self, user: str, group: str, extra_groups: list[str], env: dict[str, str]):
+    self.user = user
+    self.group = group
+    self.extra_groups = extra_groups
+    self.env = env
+
+
+user_contexts: dict[str, UserContext] = {}
+
+
+def user_context(user: str) -> UserContext:
+  context = user_contexts.get(user, None)
+  if context is None:
+    context = UserContext(
+      user = user,
+      group = group_for_user(user),
+      extra_groups = extra_groups_for_user(user),
+      env = env_for_user(user),
+    )
+    user_contexts[user] = context
+  return context
+
+
+def invalidate_user_contexts(user: str | None = None):
+  if user is None:
+    user_contexts.clear()
+  else:
+    user_contexts.pop(user, None)
+
+
 def shell(command: str, check: bool = True, executable: str = "/bin/sh", user: str | None = None):
   if verbose_mode:
     lines = cleandoc(command).split("\n")
     for idx, line in enumerate(lines):
       prefix = "$" if idx == 0 else " "
       print(f"{prefix} {line}")
+  context = user_context(user) if user else None
   with Popen(
     command,
     shell = True,
     executable = executable,
     user = user,
-    group = group_for_user(user) if user else None,
-    extra_groups = extra_groups_for_user(user) if user else None,
-    env = env_for_user(user) if user else None,
+    group = context.group if context else None,
+    extra_groups = context.extra_groups if context else None,
+    env = context.env if context else None,
   ) as process:
     exitcode = process.wait()
     assert exitcode == 0 or not check, f"command failed: {command}"
 
 
 def shell_output(command: str, check: bool = True, executable: str = "/bin/sh", user: str | None = None) -> str:
-  return run(
+  context = user_context(user) if user else None
+  return subprocess.run(
     command,
     executable = executable,
     check = check,
@@ -35,15 +76,16 @@ def shell_output(command: str, check: bool = True, executable: str = "/bin/sh",
     capture_output = True,
     universal_newlines = True,
     user = user,
-    group = group_for_user(user) if user else None,
-    extra_groups = extra_groups_for_user(user) if user else None,
-    env = env_for_user(user) if user else None,
+    group = context.group if context else None,
+    extra_groups = context.extra_groups if context else None,
+    env = context.env if context else None,
   ).stdout.strip()
 
 
 def shell_success(command: str, executable: str = "/bin/sh", user: str | None = None) -> bool:
+  context = user_context(user) if user else None
   try:
-    run(
+    subprocess.run(
       command,
       executable = executable,
       check = True,
@@ -51,15 +93,53 @@ def shell_success(command: str, executable: str = "/bin/sh", user: str | None =
       capture_output = True,
       universal_newlines = True,
       user = user,
-      group = group_for_user(user) if user else None,
-      extra_groups = extra_groups_for_user(user) if user else None,
-      env = env_for_user(user) if user else None,
+      group = context.group if context else None,
+      extra_groups = context.extra_groups if context else None,
+      env = context.env if context else None,
     )
     return True
   except CalledProcessError:
     return False
 
 
+def run(argv: Sequence[str], check: bool = True, user: str | None = None):
+  """Executes the command directly (without /bin/sh), so arguments are passed as they are and need no quoting.
+  Output is streamed to the terminal like with shell()."""
+  if verbose_mode:
+    print(f"$ {shlex.join(argv)}")
+  try:
+    exitcode = subprocess.run(argv, **user_args(user)).returncode
+  except FileNotFoundError:
+    exitcode = 127
+  assert exitcode == 0 or not check, f"command failed: {shlex.join(argv)}"
+
+
+def run_output(argv: Sequence[str], check: bool = True, user: str | None = None) -> str:
+  try:
+    return subprocess.run(argv, check = check, capture_output = True, universal_newlines = True, **user_args(user)).stdout.strip()
+  except FileNotFoundError:
+    if check:
+      raise
+    return ""
+
+
+def run_success(argv: Sequence[str], user: str | None = None) -> bool:
+  try:
+    subprocess.run(argv, check = True, capture_output = True, universal_newlines = True, **user_args(user))
+    return True
+  except (CalledProcessError, FileNotFoundError):
+    return False
+
+
+def user_args(user: str | None) -> dict[str, Any]:
+  context = user_context(user) if user else None
+  return {
+    "user": user,
+    "group": context.group if context else None,
+    "extra_groups": context.extra_groups if context else None,
+    "env": context.env if context else None,
+  }
+
 
 def group_for_user(user: str) -> str:
   gid = pwd.getpwnam(user).pw_gid
@@ -71,7 +151,7 @@ def extra_groups_for_user(user: str) -> list[str]:
 
 
 def env_for_user(user: str) -> dict[str, str]:
-  user_env_lines = run(
+  user_env_lines = subprocess.run(
     f"echo printenv | su - {user}",
     check=True,
     shell=True,
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import os
+import pwd
+
+from koti.utils.shell import run_output
+
+# states for which `systemctl is-enabled` reports success
+ENABLED_UNIT_FILE_STATES = {"enabled", "enabled-runtime", "static", "alias", "indirect", "generated", "transient"}
+
+# directories next to the unit files that hold the symlinks created by `systemctl enable`
+DEPENDENCY_DIR_SUFFIXES = (".wants", ".requires", ".upholds")
+
+
+def systemctl_for_user(user: str | None) -> list[str]:
+  return ["systemctl", "--user", "-M", f"{user}@"] if user is not None else ["systemctl"]
+
+
+class UnitEnablementSnapshot:
+  """The enablement of all units of one (system or user) service manager, taken at a single point in time."""
+  fingerprint: tuple
+  unit_file_states: dict[str, str]
+  linked_units: set[str]
+
+  def __init__(self, fingerprint: tuple, unit_file_states: dict[str, str], linked_units: set[str]):
+    self.fingerprint = fingerprint
+    self.unit_file_states = unit_file_states
+    self.linked_units = linked_units
+
+  def is_enabled(self, unit: str) -> bool | None:
+    """Returns whether `systemctl is-enabled` would succeed for the unit, or None if the snapshot can't tell."""
+    state = self.unit_file_states.get(unit, None)
+    if state is not None:
+      return state in ENABLED_UNIT_FILE_STATES
+    prefix, at, instance = unit.partition("@")
+    if not at or instance.startswith("."):
+      return None  # unknown unit
+    # instances of templates (e.g. syncthing@manuel.service) are not listed by list-unit-files, but enabling
+    # them creates a symlink with the instance name in one of the .wants/.requires directories
+    if unit in self.linked_units:
+      return True
+    template_state = self.unit_file_states.get(f"{prefix}@{instance[instance.rfind("."):]}", None)
+    if template_state is None:
+      return None
+    return template_state == "static"  # templates without [Install] section can't be enabled, but always are static
+
+
+class UnitEnablementIndex:
+  """Answers `systemctl is-enabled` for any number of units from one `systemctl list-unit-files` call per user,
+  combined with a scan of the .wants/.requires symlinks for template instances. A snapshot is retaken when the
+  mtimes of the config directories change, i.e. whenever a unit has been enabled or disabled in the meantime."""
+  snapshots: dict[str | None, UnitEnablementSnapshot | None]
+
+  def __init__(self):
+    self.snapshots = {}
+
+  def is_enabled(self, unit: str, user: str | None) -> bool | None:
+    snapshot = self.snapshot(user)
+    return snapshot.is_enabled(self.normalize(unit)) if snapshot is not None else None
+
+  def invalidate(self, user: str | None = None):
+    self.snapshots.pop(user, None)
+
+  def snapshot(self, user: str | None) -> UnitEnablementSnapshot | None:
+    config_dirs = self.config_dirs(user)
+    if config_dirs is None:
+      return None  # user doesn't exist (yet)
+    fingerprint = self.fingerprint(config_dirs)
+    snapshot = self.snapshots.get(user, None)
+    if snapshot is None or snapshot.fingerprint != fingerprint:
+      snapshot = self.take_snapshot(user, config_dirs, fingerprint)
+      self.snapshots[user] = snapshot
+    return snapshot
+
+  def take_snapshot(self, user: str | None, config_dirs: list[str], fingerprint: tuple) -> UnitEnablementSnapshot | None:
+    output = run_output([*systemctl_for_user(user), "list-unit-files", "--no-legend", "--no-pager", "--full"], check = False)
+    unit_file_states: dict[str, str] = {}
+    for line in output.splitlines():
+      columns = line.split()
+      if len(columns) >= 2:
+        unit_file_states[columns[0]] = columns[1]
+    if not unit_file_states:
+      return None  # e.g. the user manager is not running
+    linked_units: set[str] = set()
+    for config_dir in config_dirs:
+      for dependency_dir in self.dependency_dirs(config_dir):
+        try:
+          with os.scandir(dependency_dir) as entries:
+            linked_units.update(entry.name for entry in entries if entry.is_symlink())
+        except OSError:
+          return None  # changed while scanning, retry on next access
+    return UnitEnablementSnapshot(fingerprint, unit_file_states, linked_units)
+
+  @classmethod
+  def config_dirs(cls, user: str | None) -> list[str] | None:
+    if user is None:
+      return ["/etc/systemd/system"]
+    try:
+      home = pwd.getpwnam(user).pw_dir
+    except KeyError:
+      return None
+    return [os.path.join(home, ".config/systemd/user"), "/etc/systemd/user"]
+
+  @classmethod
+  def dependency_dirs(cls, config_dir: str) -> list[str]:
+    try:
+      with os.scandir(config_dir) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(DEPENDENCY_DIR_SUFFIXES) and entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+      return []
+
+  @classmethod
+  def fingerprint(cls, config_dirs: list[str]) -> tuple:
+    """Enabling or disabling a unit adds or removes a symlink (or directory) in one of these directories, which
+    changes their mtime."""
+    mtimes: list[tuple[str, int | None]] = []
+    for path in [*config_dirs, *(path for config_dir in config_dirs for path in cls.dependency_dirs(config_dir))]:
+      try:
+        mtimes.append((path, os.stat(path).st_mtime_ns))
+      except OSError:
+        mtimes.append((path, None))
+    return tuple(mtimes)
+
+  @classmethod
+  def normalize(cls, unit: str) -> str:
+    """systemctl assumes .service for unit names without a type suffix."""
+    return unit if "." in unit.rpartition("@")[2] else f"{unit}.service"
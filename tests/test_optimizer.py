@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+import pytest
+
+from koti import *
+from koti.managers.checkpoint import CheckpointManager
+from koti.managers.pacman import PacmanPackageManager
+from koti.managers.user import UserManager
+from koti.optimizer import InstallOrderStrategy, InstallPhaseOptimizer
+
+
+def install_cost(configs: list[list[ManagedConfigItem]], strategy: InstallOrderStrategy) -> float:
+  managers = [UserManager(), PacmanPackageManager(), CheckpointManager()]
+  optimizer = InstallPhaseOptimizer(configs, managers, strategy = strategy, plan_cache = None)
+  return sum(step.manager.invocation_cost for step in optimizer.calc_install_steps())
+
+
+def test_solver_merges_components_without_extra_cost():
+  u0 = User("u0")
+  configs: list[list[ManagedConfigItem]] = [
+    [u0, Checkpoint("c1"), Package("p2", after = u0)],
+    [Package("p3"), Checkpoint("c4"), Package("p5", after = u0), Package("p6")],
+    [Package("p14"), User("u15")],
+  ]
+  solver_cost = install_cost(configs, "solver")
+  assert solver_cost <= install_cost(configs, "graph")
+  assert solver_cost == pytest.approx(21.1)  # user, pacman, checkpoint, pacman
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from subprocess import CalledProcessError
+from typing import Sequence
+
+import pytest
+
+import koti.utils.pacman_keyring
+from koti.utils.pacman_keyring import PacmanKeyring
+
+
+def test_keys_are_listed_with_gpg(monkeypatch: pytest.MonkeyPatch):
+  calls: list[list[str]] = []
+
+  def run_output(argv: Sequence[str], check: bool = True, user: str | None = None) -> str:
+    calls.append(list(argv))
+    return "pub:-:4096:1:786C63F330D7CB92:1570000000:::-:::scESC::::::23::0:\nfpr:::::::::ABAF11C65A2970B130ABE3C479BE3E4300411886:"
+
+  monkeypatch.setattr(koti.utils.pacman_keyring, "run_output", run_output)
+  keyring = PacmanKeyring()
+  assert keyring.contains("0x786c63f330d7cb92")
+  assert keyring.contains("ABAF 11C6 5A29 70B1 30AB E3C4 79BE 3E43 0041 1886")
+  assert not keyring.contains("0000000000000000")
+  assert calls == [["gpg", "--homedir", "/etc/pacman.d/gnupg", "--batch", "--list-keys", "--with-colons"]]
+
+
+def test_keys_are_checked_one_by_one_if_listing_fails(monkeypatch: pytest.MonkeyPatch):
+  checked: list[list[str]] = []
+
+  def run_output(argv: Sequence[str], check: bool = True, user: str | None = None) -> str:
+    raise CalledProcessError(2, argv)
+
+  def run_success(argv: Sequence[str], user: str | None = None) -> bool:
+    checked.append(list(argv))
+    return argv[-1] == "786C63F330D7CB92"
+
+  monkeypatch.setattr(koti.utils.pacman_keyring, "run_output", run_output)
+  monkeypatch.setattr(koti.utils.pacman_keyring, "run_success", run_success)
+  keyring = PacmanKeyring()
+  assert keyring.keys() is None
+  assert keyring.contains("0x786c63f330d7cb92")
+  assert not keyring.contains("0000000000000000")
+  assert checked == [["pacman-key", "--list-keys", "786C63F330D7CB92"], ["pacman-key", "--list-keys", "0000000000000000"]]